@@ -0,0 +1,105 @@
+// Theme switch, day player, mapped interval and farm table applied in
+// the browser: only the properties involved change, the figures never
+// go through the server.
+
+// map layers of a theme: the frame of the day if one is picked and the
+// daily maps exist, else the average
+function map_layers(name, rasters, frames, day) {
+    if (frames && frames[name] && day !== null && day >= 0) {
+        return frames[name].map(layer => Object.assign({}, layer, {
+            source: layer.source.replace('{day}', day)
+        }));
+    }
+    return rasters && rasters[name];
+}
+
+function with_layers(fig, layers) {
+    fig = Object.assign({}, fig);
+    fig.layout = Object.assign({}, fig.layout);
+    fig.layout.mapbox = Object.assign({}, fig.layout.mapbox, {layers: layers});
+    return fig;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    sealice: {
+        switch_theme: function(toggle, fig, curves, themes, rasters, frames, day) {
+            const name = toggle ? 'dark' : 'light';
+            const theme = themes[name];
+            const layers = map_layers(name, rasters, frames, day);
+            if (layers) {
+                fig = with_layers(fig, layers);
+            }
+            fig = Object.assign({}, fig);
+            fig.layout = Object.assign({}, fig.layout, {template: theme.template});
+            fig.layout.mapbox = Object.assign({}, fig.layout.mapbox, {style: theme.carto_style});
+            // the first trace only carries the colorbar of the raster
+            fig.data = fig.data.slice();
+            fig.data[0] = Object.assign({}, fig.data[0]);
+            fig.data[0].marker = Object.assign({}, fig.data[0].marker,
+                                               {colorscale: theme.colorscale});
+            curves = Object.assign({}, curves);
+            curves.layout = Object.assign({}, curves.layout, {template: theme.template});
+            return [fig, curves];
+        },
+
+        show_day: function(day, toggle, fig, rasters, frames) {
+            const name = toggle ? 'dark' : 'light';
+            const layers = map_layers(name, rasters, frames, day);
+            if (!layers) {
+                return window.dash_clientside.no_update;
+            }
+            // load the next frames while this one is displayed
+            if (day >= 0 && frames && frames[name]) {
+                for (let ahead = 1; ahead <= 2; ahead++) {
+                    map_layers(name, rasters, frames, day + ahead).forEach(layer => {
+                        new Image().src = layer.source;
+                    });
+                }
+            }
+            return with_layers(fig, layers);
+        },
+
+        // the shaded interval of the progress curves follows the map
+        move_window: function(start, end, curves) {
+            if (!start || !end || !curves.layout.shapes) {
+                return window.dash_clientside.no_update;
+            }
+            curves = Object.assign({}, curves);
+            curves.layout = Object.assign({}, curves.layout);
+            curves.layout.shapes = curves.layout.shapes.slice();
+            curves.layout.shapes[0] = Object.assign({}, curves.layout.shapes[0],
+                                                    {x0: start, x1: end});
+            if (curves.layout.annotations) {
+                curves.layout.annotations = curves.layout.annotations.slice();
+                curves.layout.annotations[0] = Object.assign({}, curves.layout.annotations[0],
+                                                             {x: start});
+            }
+            return curves;
+        },
+
+        toggle_play: function(n_clicks) {
+            const playing = n_clicks % 2 === 1;
+            return [!playing, playing ? 'Pause' : 'Play'];
+        },
+
+        next_day: function(n_intervals, day, max) {
+            return day === null || day >= max ? 0 : day + 1;
+        },
+
+        // the global sliders set every farm of the table
+        set_all_farms: function(lice, biomass, rows) {
+            return rows.map(row => Object.assign({}, row, {biomass: biomass, lice: lice}));
+        },
+
+        // the table as the three vectors redraw receives, in the order
+        // of the processed farms whatever the sorting of the table
+        farm_coefficients: function(rows) {
+            const positive = value => Math.max(0, Number(value) || 0);
+            return {
+                on: rows.map(row => row.on !== 'off'),
+                biomass: rows.map(row => positive(row.biomass)),
+                lice: rows.map(row => positive(row.lice))
+            };
+        }
+    }
+});
@@ -0,0 +1,284 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+'''
+Benchmark of the render path on a synthetic bucket, no GCS access needed.
+
+    python benchmark.py --farms 40 --extent 40 --res 0 --save base.json
+    python benchmark.py --farms 40 --extent 40 --res 0 --compare base.json
+
+--res is the index in main.resolution_M (0: 50m, 1: 100m, 2: 200m).
+'''
+
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import fsspec
+import numpy as np
+from fsspec.implementations.dirfs import DirFileSystem
+
+import synthetic
+
+
+def use_bucket(main, fs, farm_loc, coordinates, workdir, dtype='float32'):
+    '''
+    Point the app at a synthetic bucket and keep its local files in workdir
+    '''
+    from registry import LayerRegistry
+    from render_cache import RenderCache
+    main.gcs_fs = lambda: fs
+    main.farm_file = os.path.join(workdir, 'modelled_farms.npy')
+    main.coord_file = os.path.join(workdir, 'master_coordinates.npy')
+    np.save(main.farm_file, farm_loc)
+    np.save(main.coord_file, coordinates)
+    main.chunk_cache = RenderCache(os.path.join(workdir, 'chunks'), max_memory=0)
+    main.layer_registry = LayerRegistry(os.path.join(workdir, 'layers'),
+                                        main.open_master, main.master_version, dtype=dtype)
+    main.render_cache = RenderCache(os.path.join(workdir, 'render'))
+    main.composite_cache = RenderCache(os.path.join(workdir, 'composite'))
+
+
+def redraw_payload(main, r, n_farms):
+    '''
+    Body of the Dash request of a "Refresh map" click with the defaults
+    '''
+    from dash_bootstrap_templates import ThemeSwitchAIO
+    output = [key for key in main.app.callback_map if 'raster-sources.data' in key][0]
+
+    return {
+        'output': output,
+        'outputs': [{'id': 'heatmap', 'property': 'figure'},
+                    {'id': 'raster-sources', 'property': 'data'},
+                    {'id': 'frame-sources', 'property': 'data'},
+                    {'id': 'scenario-key', 'property': 'data'},
+                    {'id': 'heatmap_output', 'property': 'children'}],
+        'inputs': [{'id': 'submit_map', 'property': 'n_clicks', 'value': 1},
+                   {'id': 'window-picker', 'property': 'start_date', 'value': main.start},
+                   {'id': 'window-picker', 'property': 'end_date', 'value': main.end}],
+        'changedPropIds': ['submit_map.n_clicks'],
+        'state': [{'id': ThemeSwitchAIO.ids.switch('theme'), 'property': 'value',
+                   'value': True},
+                  {'id': 'egg_toggle', 'property': 'on', 'value': False},
+                  {'id': 'farm-coefficients', 'property': 'data',
+                   'value': {'on': [True] * n_farms, 'biomass': [1] * n_farms,
+                             'lice': [0.5] * n_farms}},
+                  {'id': 'span-slider', 'property': 'value', 'value': main.span},
+                  {'id': 'resolution-slider', 'property': 'value', 'value': r},
+                  {'id': 'my-store', 'property': 'data', 'value': None},
+                  {'id': 'day-slider', 'property': 'value', 'value': -1}],
+    }
+
+
+def mk_img(main, compositor, names, coeff):
+    '''
+    Whole image of a scenario: composite and shading, no cache
+    '''
+    arr = compositor.render(names, coeff, timed=main.metrics.stage)
+    return main.shade(arr, main.span, main.palette(main.cmp1))
+
+
+def stages(main, r):
+    '''
+    [(name, run, work)]: run() does the stage once, work is the amount
+    processed by one run for the throughput
+    '''
+    from compositor import Compositor
+    from layers import FarmLayers, accuracy
+    from images import encode_image
+    from shading import compare_datashader
+    from xarray import DataArray
+    from datashader import transfer_functions as tf
+    from tiles import tiles_covering
+
+    farms = main.farm_data()
+    names = farms.name[farms.processed]
+    coeff = np.ones(len(names))
+    layers = main.layer_registry.get(r)
+    dense = FarmLayers.from_dataset(main.open_master(r))
+    print('{} {}: {:.1f} MB, dense: {:.1f} MB'.format(
+        type(layers).__name__, layers.data.dtype, layers.nbytes / 2**20, dense.nbytes / 2**20))
+    if layers.scale is not None:
+        print('error against float32: {}'.format(accuracy(dense, layers, n=5)))
+    coordinates = main.master_coordinates()
+    compositor = Compositor(layers)
+    w = layers.coefficients(names, coeff)
+    pixels = layers.shape[0] * layers.shape[1]
+    img = mk_img(main, compositor, names, coeff)
+    png = encode_image(img)
+    params = {'r': r, 'names': list(names), 'coeff': list(coeff), 'span': main.span,
+              'cmap': main.cmp1}
+    tiles = tiles_covering(coordinates[::-1], 8)
+    fig = main.make_base_figure(farms, main.center_lat,
+                                main.center_lon, main.span,
+                                main.palette(main.cmp1), main.template_theme1)
+    client = main.server.test_client()
+    payload = redraw_payload(main, r, len(names))
+    delta = coeff.copy()
+
+    def delta_render():
+        delta[0] += 0.5
+        compositor.render(names, delta, session='bench')
+
+    def reshade():
+        # a new span on a scenario whose composite is cached
+        params['span'] = [main.span[0], params['span'][1] + 1]
+        main.shade(main.aggregate(compositor, params), params['span'],
+                   main.palette(main.cmp1))
+
+    def redraw(use_tiles):
+        def run():
+            main.use_tiles = use_tiles
+            main.render_cache = type(main.render_cache)(tempfile.mkdtemp())
+            main.composite_cache = type(main.composite_cache)(tempfile.mkdtemp())
+            response = client.post('/_dash-update-component', json=payload)
+            assert response.status_code == 200, response.status_code
+            return len(response.data)
+        return run
+
+    compositor.render(names, delta, session='bench')
+    arr = compositor.masked(w).copy()
+    cmap = main.palette(main.cmp1)
+    print('shading max channel difference with datashader: {}'.format(
+        compare_datashader(arr, main.span, cmap)))
+
+    def datashader_shade():
+        tf.shade(DataArray(arr, dims=('y', 'x')), cmap=cmap, how='linear',
+                 span=main.span).to_pil()
+
+    daily = []
+    if main.open_daily(r) is not None:
+        scenario = dict(params, r=r, egg=False)
+        main.register_scenario('bench', scenario)
+        day = iter(range(main.open_daily(r).sizes['time']))
+
+        def frame():
+            # a day not rendered yet
+            main.frame_bytes('bench', next(day))
+
+        def window():
+            # the average of every day, from the first and last cumulative slices
+            main.composite_cache = type(main.composite_cache)(tempfile.mkdtemp())
+            days = main.window_times()
+            main.window_aggregate(dict(scenario, window=[days[0], days[-1]]))
+
+        daily = [('daily frame', frame, pixels), ('window composite', window, pixels)]
+
+    return daily + [
+        ('composite', lambda: compositor.masked(w), pixels * len(names)),
+        ('dense composite', lambda: dense.composite(w), pixels * len(names)),
+        ('delta composite', delta_render, pixels),
+        ('mk_img', lambda: mk_img(main, compositor, names, coeff), pixels),
+        ('datashader shade', datashader_shade, pixels),
+        ('lut shade', lambda: main.shade(arr, main.span, cmap), pixels),
+        ('reshade', reshade, pixels),
+        ('png encode', lambda: encode_image(img), len(png)),
+        ('point query', lambda: main.point_query(params, *coordinates.mean(axis=0)),
+         1),
+        ('tiles z8', lambda: [main.mk_tile(compositor, coordinates, params, 8, x, y)
+                              for x, y in tiles], len(tiles)),
+        ('make_base_figure', lambda: main.make_base_figure(
+            farms, main.center_lat, main.center_lon, main.span,
+            main.palette(main.cmp1), main.template_theme1), len(farms)),
+        ('tab2_layout', lambda: main.tab2_layout(farms), len(farms)),
+        ('figure json', lambda: fig.to_json(), 1),
+        ('mk_curves', lambda: main.mk_curves(main.start, main.end), len(names)),
+        ('redraw tiles', redraw(True), 1),
+        ('redraw image', redraw(False), 1),
+    ]
+
+
+def measure(run, repeat):
+    '''
+    Median and best time over repeat runs, then the peak of the memory
+    allocated during one more run
+    '''
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(times), min(times), peak
+
+
+def run_suite(args):
+    workdir = tempfile.mkdtemp(prefix='sealice_bench_')
+    if args.memory:
+        fs = DirFileSystem('/bench', fs=fsspec.filesystem('memory'))
+    else:
+        fs = DirFileSystem(os.path.join(workdir, 'bucket'), fs=fsspec.filesystem('file'))
+    t0 = time.perf_counter()
+    farm_loc, coordinates = synthetic.mk_bucket(
+        fs, n_farms=args.farms, extent_km=args.extent,
+        n_time=args.times, n_particles=args.particles, n_days=args.days)
+    print('synthetic bucket written in {:.1f}s'.format(time.perf_counter() - t0))
+    import main
+    use_bucket(main, fs, farm_loc, coordinates, workdir, args.dtype)
+    t0 = time.perf_counter()
+    main.layer_registry.get(args.res)
+    print('layers of {}m built in {:.1f}s'.format(main.resolution_M[args.res],
+                                                 time.perf_counter() - t0))
+    results = {}
+    for name, run, work in stages(main, args.res):
+        median, best, peak = measure(run, args.repeat)
+        results[name] = {'median_s': median, 'best_s': best,
+                         'throughput': work / median, 'peak_mb': peak / 2**20}
+        print('{:<18} {:9.4f}s (best {:.4f}s) {:12.4g}/s  peak {:8.1f} MB'.format(
+            name, median, best, work / median, peak / 2**20))
+    return results
+
+
+def compare(results, baseline):
+    print('\n{:<18} {:>10} {:>10} {:>8}'.format('stage', 'baseline', 'now', 'ratio'))
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        ratio = res['median_s'] / baseline[name]['median_s']
+        flag = 'slower' if ratio > 1.1 else 'faster' if ratio < 0.9 else ''
+        print('{:<18} {:9.4f}s {:9.4f}s {:7.2f}x {}'.format(
+            name, baseline[name]['median_s'], res['median_s'], ratio, flag))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--farms', type=int, default=40)
+    parser.add_argument('--extent', type=float, default=40, help='grid side in km')
+    parser.add_argument('--res', type=int, default=0, help='resolution index')
+    parser.add_argument('--times', type=int, default=120, help='trajectory time steps')
+    parser.add_argument('--particles', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=0,
+                        help='days of the daily maps, 0: no daily maps')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dtype', default='float32', help='storage of the layers')
+    parser.add_argument('--memory', action='store_true',
+                        help='in-memory bucket instead of a local directory')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--compare', help='baseline json file to compare with')
+    args = parser.parse_args()
+    results = run_suite(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
@@ -0,0 +1,118 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import hashlib
+import itertools
+import json
+import math
+from collections.abc import MutableMapping
+
+from registry import store_token
+
+
+class CachedStore(MutableMapping):
+    '''
+    zarr mapping over any fsspec filesystem reading through a local cache
+    of chunks, a RenderCache shared by all the stores so that they fit
+    in one size cap (see main.chunk_cache). cache=None reads straight
+    from fs, for the stores only read once.
+    The chunks are keyed on the generation of the store metadata, a
+    rewritten store is fetched again and the chunks of the previous
+    generation age out of the LRU.
+    '''
+    def __init__(self, fs, root, cache=None):
+        self.fs = fs
+        self.root = root.rstrip('/')
+        self.mapper = fs.get_mapper(self.root)
+        self.cache = cache
+        if cache is not None:
+            token = str(store_token(fs, self.root))
+            self.prefix = '{}-{}-'.format(hashlib.sha1(self.root.encode()).hexdigest()[:16],
+                                          hashlib.sha1(token.encode()).hexdigest()[:16])
+
+    def _cached(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(self.prefix + key)
+
+    def _keep(self, key, data):
+        '''
+        Copy a chunk to the cache, a full /tmp only costs the copy
+        '''
+        if self.cache is None:
+            return
+        try:
+            self.cache.set(self.prefix + key, data)
+        except OSError as exc:
+            print('chunk cache: {!r}'.format(exc))
+
+    def __getitem__(self, key):
+        data = self._cached(key)
+        if data is None:
+            data = self.mapper[key]
+            self._keep(key, data)
+        return data
+
+    def __contains__(self, key):
+        if self.cache is not None and self.prefix + key in self.cache:
+            return True
+        return key in self.mapper
+
+    def __setitem__(self, key, value):
+        raise PermissionError('{} is read only'.format(self.root))
+
+    def __delitem__(self, key):
+        raise PermissionError('{} is read only'.format(self.root))
+
+    def __iter__(self):
+        return iter(self.mapper)
+
+    def __len__(self):
+        return len(self.mapper)
+
+    def chunk_keys(self, variable):
+        '''
+        Keys of all the chunks of a variable from its .zarray
+        '''
+        meta = json.loads(self[variable + '/.zarray'])
+        sep = meta.get('dimension_separator') or '.'
+        counts = [math.ceil(s / c) for s, c in zip(meta['shape'], meta['chunks'])]
+        if not counts:
+            return [variable + '/0']
+        return [variable + '/' + sep.join(map(str, idx))
+                for idx in itertools.product(*map(range, counts))]
+
+    def arrays(self):
+        '''
+        Paths of all the arrays of the store from its consolidated metadata
+        '''
+        meta = json.loads(self['.zmetadata'])['metadata']
+        return [key[:-len('/.zarray')] for key in meta if key.endswith('/.zarray')]
+
+    def prefetch(self, variables=None):
+        '''
+        Fetch every chunk of the variables (all the arrays by default)
+        not cached yet in one concurrent request, the missing chunks are
+        fill values. Nothing to keep them in without a cache.
+        '''
+        if self.cache is None:
+            return 0
+        if variables is None:
+            variables = self.arrays()
+        keys = [key for variable in variables for key in self.chunk_keys(variable)
+                if self.prefix + key not in self.cache]
+        if keys:
+            for key, data in self.mapper.getitems(keys, on_error='omit').items():
+                self._keep(key, data)
+        return len(keys)
@@ -0,0 +1,152 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import contextlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class SessionState:
+    '''
+    Last composite of a session with the coefficients it was built from
+    '''
+    def __init__(self, shape):
+        self.composite = np.empty(shape, dtype='float32')
+        self.w = None
+        self.updates = 0
+        self.lock = threading.Lock()
+
+
+class Compositor:
+    '''
+    Weighted sum of the farm layers of one resolution.
+    The layers are only read, the result goes to output buffers
+    allocated once per thread and reused by the next renders.
+    The last composite of the max_sessions most recent sessions is kept
+    so that a new render only adds (new - old) * layer for the farms
+    whose coefficient changed. It is rebuilt from scratch when more than
+    max_changed (a fraction of the farms) changed or after max_updates
+    deltas, which bounds the float32 rounding drift, and when a farm is
+    switched off: subtracting its layer leaves rounding residues where
+    the density is 0, they would be drawn instead of transparent.
+    '''
+    def __init__(self, layers, max_sessions=4, max_changed=0.25,
+                 max_updates=32):
+        self.layers = layers
+        self.max_sessions = max_sessions
+        self.max_changed = max_changed
+        self.max_updates = max_updates
+        self._local = threading.local()
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def buffers(self):
+        '''
+        The (composite, mask) buffers of the calling thread
+        '''
+        local = self._local
+        if not hasattr(local, 'out'):
+            local.out = np.empty(self.layers.shape, dtype='float32')
+            local.mask = np.empty(self.layers.shape, dtype='bool')
+        return local.out, local.mask
+
+    def composite(self, w):
+        '''
+        Raw weighted sum for the full coefficient vector w
+        '''
+        out, _ = self.buffers()
+        return self.layers.composite(w, out=out)
+
+    def masked(self, w):
+        '''
+        Weighted sum with NaN where the density is <= 0.
+        The returned array is the thread buffer, it is only valid
+        until the next call from the same thread.
+        '''
+        out, mask = self.buffers()
+        self.layers.composite(w, out=out)
+        np.less_equal(out, 0, out=mask)
+        np.copyto(out, np.nan, where=mask)
+        return out
+
+    def session(self, key):
+        '''
+        State of a session, the least recently used one is dropped
+        '''
+        with self._lock:
+            state = self._sessions.get(key)
+            if state is None:
+                state = self._sessions[key] = SessionState(self.layers.shape)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(key)
+            return state
+
+    def update(self, state, w):
+        '''
+        Bring the session composite to the coefficients w, returns the
+        number of farms applied as deltas (None for a full rebuild)
+        '''
+        if state.w is not None:
+            changed = np.flatnonzero(w != state.w)
+            if (len(changed) <= self.max_changed * len(self.layers)
+                    and state.updates < self.max_updates
+                    and w[changed].all()):
+                tmp, _ = self.buffers()
+                for i in changed:
+                    self.layers.add(i, w[i] - state.w[i], state.composite, tmp)
+                state.w = w
+                state.updates += len(changed) > 0
+                return len(changed)
+        self.layers.composite(w, out=state.composite)
+        state.w = w
+        state.updates = 0
+        return None
+
+    def render(self, name_list, Coeff, session=None, timed=None):
+        '''
+        Masked composite for the farms of name_list, incremental from
+        the previous render of the session if a session key is given.
+        timed(stage) gives a context manager timing each stage, yielding
+        the dict the bytes it produced are set in.
+        '''
+        timed = timed or (lambda stage: contextlib.nullcontext({'bytes': 0}))
+        out, mask = self.buffers()
+        with timed('coefficient build') as info:
+            w = self.layers.coefficients(name_list, Coeff)
+            info['bytes'] = w.nbytes
+        if session is None:
+            with timed('composite') as info:
+                self.layers.composite(w, out=out)
+                info['bytes'] = out.nbytes
+            with timed('mask') as info:
+                np.less_equal(out, 0, out=mask)
+                np.copyto(out, np.nan, where=mask)
+                info['bytes'] = mask.nbytes
+            return out
+        state = self.session(session)
+        with state.lock:
+            with timed('composite') as info:
+                self.update(state, w)
+                info['bytes'] = state.composite.nbytes
+            with timed('mask') as info:
+                np.less_equal(state.composite, 0, out=mask)
+                np.copyto(out, state.composite)
+                info['bytes'] = mask.nbytes
+        with timed('mask') as info:
+            np.copyto(out, np.nan, where=mask)
+            info['bytes'] = out.nbytes
+        return out
@@ -0,0 +1,45 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import numpy as np
+
+
+class FarmRegistry:
+    '''
+    The farms of modelled_farms.npy as typed columns: name, biomass
+    (tons), lat and lon.
+    computed flags the farms with a layer in layer_names, the others are
+    not processed yet. processed holds the rows of the computed farms,
+    the order of the farm controls of the dashboard.
+    '''
+    def __init__(self, names, biomass, lat, lon, layer_names):
+        self.name = np.asarray(names, dtype=str)
+        self.biomass = np.asarray(biomass, dtype='float64')
+        self.lat = np.asarray(lat, dtype='float64')
+        self.lon = np.asarray(lon, dtype='float64')
+        self.computed = np.isin(self.name, np.asarray(list(layer_names), dtype=str))
+        self.processed = np.flatnonzero(self.computed)
+
+    @classmethod
+    def from_array(cls, farm_loc, layer_names):
+        '''
+        From the object array of modelled_farms.npy:
+        name, biomass, ..., lat, lon
+        '''
+        return cls(farm_loc[:, 0], farm_loc[:, 1].astype('float64'),
+                   farm_loc[:, -2].astype('float64'), farm_loc[:, -1].astype('float64'),
+                   layer_names)
+
+    def __len__(self):
+        return len(self.name)
@@ -0,0 +1,89 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+'''
+Daily maps. The daily store of a resolution has the layout of
+master.zarr with a leading time dimension chunked by day: one
+(time, y, x) variable per farm, so a frame only reads one chunk row
+of the farms in the scenario.
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from progress import load_all
+
+
+def daily_composite(ds, names, coeff, day, max_workers=8):
+    '''
+    Weighted sum of the layers of day, NaN where the density is <= 0.
+    The farms without daily layers are left out, the layers are read
+    concurrently.
+    '''
+    shape = (ds.sizes['y'], ds.sizes['x'])
+    weights = {name: c for name, c in zip(names, coeff) if name in ds.data_vars}
+    out = np.zeros(shape, dtype='float32')
+
+    def read(name):
+        return ds[name].isel(time=day).values
+
+    layers, errors = load_all(list(weights), read, max_workers=max_workers)
+    if errors:
+        raise IOError('cannot read the day {} of {}'.format(day, ', '.join(errors)))
+    for name, layer in layers:
+        out += weights[name] * np.nan_to_num(layer, copy=False)
+    out[out <= 0] = np.nan
+    return out
+
+
+def day_marks(days, every=7):
+    '''
+    Slider marks: the average at -1 then one day of every week
+    '''
+    marks = {-1: 'Average'}
+    marks.update({i: str(day)[5:] for i, day in enumerate(days) if i % every == 0})
+    return marks
+
+
+class Prefetcher:
+    '''
+    Run func(*args) in background threads, at most once at a time for
+    the same args, to render the frames ahead of the one displayed.
+    Requests above max_pending are dropped, scrubbing the slider must
+    not queue the whole season.
+    '''
+    def __init__(self, func, max_workers=2, max_pending=16):
+        self.func = func
+        self.max_pending = max_pending
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='prefetch')
+
+    def submit(self, *args):
+        with self._lock:
+            if args in self._pending or len(self._pending) >= self.max_pending:
+                return False
+            self._pending.add(args)
+        self._pool.submit(self._run, args)
+        return True
+
+    def _run(self, args):
+        try:
+            self.func(*args)
+        except Exception as exc:
+            print('prefetch {} failed: {!r}'.format(args, exc))
+        finally:
+            with self._lock:
+                self._pending.discard(args)
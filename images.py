@@ -0,0 +1,62 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import hashlib
+import io
+import flask
+
+# PIL format, mime type and encoder options
+IMAGE_FORMATS = {
+    'png': ('PNG', 'image/png', {}),
+    'webp': ('WEBP', 'image/webp', {'lossless': True, 'quality': 50}),
+}
+
+
+def encode_image(img, fmt='png'):
+    '''
+    PIL image to PNG or WebP bytes
+    '''
+    pil_format, _, options = IMAGE_FORMATS[fmt]
+    buf = io.BytesIO()
+    img.save(buf, format=pil_format, **options)
+    return buf.getvalue()
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()[:20]
+
+
+def not_modified(etag):
+    '''
+    304 response if the browser already has etag, else None
+    '''
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def image_response(data, fmt, etag, max_age=86400):
+    '''
+    Image response that the browsers and proxies can keep,
+    the urls are content addressed so they never change
+    '''
+    response = flask.make_response(data)
+    response.headers['Content-Type'] = IMAGE_FORMATS[fmt][1]
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response.make_conditional(flask.request)
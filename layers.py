@@ -0,0 +1,416 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import os.path
+import sys
+import numpy as np
+
+# storage of the layer values, decoded as value * scale + offset
+DTYPES = ('float32', 'float16', 'uint16')
+BLOCK = 1 << 15 # pixels decoded at once by the dense quantised sum
+
+
+def encode(layer, dtype='float32'):
+    '''
+    layer in dtype with the scale and offset decoding it.
+    uint16 spreads the range of the layer over the 65536 levels.
+    '''
+    if dtype == 'uint16':
+        lo = float(layer.min()) if layer.size else 0.
+        scale = (float(layer.max()) - lo) / 65535 if layer.size else 0.
+        scale = scale or 1.
+        return np.round((layer - lo) / scale).astype('uint16'), scale, lo
+    return layer.astype(dtype), 1., 0.
+
+
+class FarmLayers:
+    '''
+    All the farm layers of a master.zarr as one contiguous
+    (n_farms, y, x) array with a name -> row index.
+    The values are float32, or float16/uint16 (see encode) with a per
+    farm scale and offset applied within the weighted sums.
+    '''
+    def __init__(self, data, names, y, x, scale=None, offset=None):
+        self.data = data
+        self.names = np.asarray(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.y = np.asarray(y)
+        self.x = np.asarray(x)
+        # None for float32 layers used as they are
+        self.scale = None if scale is None else np.asarray(scale, dtype='float32')
+        self.offset = None if offset is None else np.asarray(offset, dtype='float32')
+
+    def decoding(self, i, c):
+        '''
+        Factor and constant of the layer i weighted by c
+        '''
+        if self.scale is None:
+            return c, 0.
+        return c * self.scale[i], c * self.offset[i]
+
+    @property
+    def shape(self):
+        return self.data.shape[1:]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @classmethod
+    def from_dataset(cls, ds, mmap_path=None, dtype='float32'):
+        '''
+        Copy every farm variable of ds into the tensor, one farm at a time
+        so the peak memory is a single layer on top of the tensor.
+        NaNs are stored as 0 as they were skipped by the stacked sum.
+        If mmap_path is given the tensor is written to a .npy file and
+        memory-mapped, the names and coordinates go to a .npz next to it.
+        '''
+        names = list(ds.keys())
+        return cls.from_layers(names, (ds[name].values for name in names),
+                               (ds.sizes['y'], ds.sizes['x']), ds.coords['y'].values,
+                               ds.coords['x'].values, mmap_path, dtype)
+
+    @classmethod
+    def from_layers(cls, names, layers, shape, y, x, mmap_path=None, dtype='float32'):
+        '''
+        Tensor of the (y, x) arrays of the iterable layers, one per name,
+        taken one at a time. mmap_path as in from_dataset.
+        '''
+        shape = (len(names),) + tuple(shape)
+        if mmap_path is None:
+            data = np.empty(shape, dtype=dtype)
+        else:
+            data = np.lib.format.open_memmap(mmap_path, mode='w+',
+                                             dtype=dtype, shape=shape)
+        scale, offset = np.ones(len(names)), np.zeros(len(names))
+        for i, values in enumerate(layers):
+            layer = np.nan_to_num(values.astype('float32', copy=False))
+            data[i], scale[i], offset[i] = encode(layer, dtype)
+        codec = {} if dtype == 'float32' else {'scale': scale, 'offset': offset}
+        if mmap_path is not None:
+            data.flush()
+            np.savez(coords_path(mmap_path), names=np.array(names), y=y, x=x, **codec)
+            return cls.load(mmap_path)
+        return cls(data, names, y, x, **codec)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Reopen a tensor written by from_dataset(ds, mmap_path=path)
+        '''
+        data = np.load(path, mmap_mode=mmap_mode)
+        with np.load(coords_path(path)) as meta:
+            return cls(data, meta['names'], meta['y'], meta['x'],
+                       *(meta[key] if key in meta else None for key in ('scale', 'offset')))
+
+    def rows(self, name_list):
+        '''
+        Row of each farm of name_list in the tensor
+        '''
+        return np.fromiter((self.index[name] for name in name_list),
+                           dtype='intp', count=len(name_list))
+
+    def coefficients(self, name_list, Coeff):
+        '''
+        Full length coefficient vector, 0 for the farms not in name_list
+        '''
+        w = np.zeros(len(self), dtype='float32')
+        w[self.rows(name_list)] = Coeff
+        return w
+
+    def composite(self, w, out=None):
+        '''
+        Weighted sum of all the layers as one contraction over the farms,
+        written into out (a float32 (y, x) C-contiguous array) if given
+        '''
+        w = np.asarray(w, dtype='float32')
+        flat = self.data.reshape(len(self), -1)
+        if self.scale is None:
+            if out is None:
+                return np.dot(w, flat).reshape(self.shape)
+            np.dot(w, flat, out=out.reshape(-1))
+            return out
+        # quantised: decoded one block of pixels at a time
+        if out is None:
+            out = np.empty(self.shape, dtype='float32')
+        nz = np.flatnonzero(w)
+        ws = w[nz] * self.scale[nz]
+        flat_out = out.reshape(-1)
+        for start in range(0, flat.shape[1], BLOCK):
+            block = flat[nz, start:start + BLOCK].astype('float32')
+            np.dot(ws, block, out=flat_out[start:start + BLOCK])
+        flat_out += np.dot(w[nz], self.offset[nz])
+        return out
+
+    def add(self, i, c, out, tmp):
+        '''
+        out += c * layer i, tmp is a scratch array of the shape of out
+        '''
+        factor, constant = self.decoding(i, c)
+        np.multiply(self.data[i], factor, out=tmp)
+        out += tmp
+        if constant:
+            out += constant
+
+    def window(self, w, r0, r1, c0, c1):
+        '''
+        Weighted sum of the layers on the rows r0:r1 and columns c0:c1
+        '''
+        nz = np.flatnonzero(w)
+        if self.scale is None:
+            return np.tensordot(w[nz], self.data[nz, r0:r1, c0:c1], axes=1)
+        window = np.tensordot(w[nz] * self.scale[nz],
+                              self.data[nz, r0:r1, c0:c1].astype('float32'), axes=1)
+        return window + np.dot(w[nz], self.offset[nz])
+
+    def column(self, row, col):
+        '''
+        Value of every layer at one pixel
+        '''
+        values = self.data[:, row, col].astype('float32')
+        if self.scale is None:
+            return values
+        return values * self.scale + self.offset
+
+
+class SparseFarmLayers(FarmLayers):
+    '''
+    Farm layers stored as their bounding box only: a farm plume covers
+    a small part of the grid, the zeros around it are neither kept nor
+    summed. boxes are the (r0, r1, c0, c1) of each farm, the boxes are
+    packed one after the other in the flat float32 values from offsets.
+    '''
+    def __init__(self, values, boxes, offsets, shape, names, y, x, scale=None, offset=None):
+        super().__init__(values, names, y, x, scale, offset)
+        self.values = values
+        self.boxes = np.asarray(boxes)
+        self.offsets = np.asarray(offsets)
+        self._shape = tuple(int(n) for n in shape)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def layer(self, i):
+        r0, r1, c0, c1 = self.boxes[i]
+        return self.values[self.offsets[i]:self.offsets[i + 1]].reshape(r1 - r0, c1 - c0)
+
+    @classmethod
+    def pack(cls, names, boxes, parts, shape, y, x, mmap_path=None, dtype='float32'):
+        '''
+        Layers from the box and the flat cropped array of each farm,
+        written and memory-mapped like FarmLayers if mmap_path is given
+        '''
+        offsets = np.cumsum([0] + [len(part) for part in parts])
+        if mmap_path is None:
+            values = np.empty(int(offsets[-1]), dtype=dtype)
+        else:
+            values = np.lib.format.open_memmap(mmap_path, mode='w+',
+                                               dtype=dtype, shape=(int(offsets[-1]),))
+        scale, offset = np.ones(len(parts)), np.zeros(len(parts))
+        for i, (part, start) in enumerate(zip(parts, offsets)):
+            values[start:start + len(part)], scale[i], offset[i] = encode(part, dtype)
+        codec = {} if dtype == 'float32' else {'scale': scale, 'offset': offset}
+        if mmap_path is not None:
+            values.flush()
+            np.savez(coords_path(mmap_path), names=np.array(names), y=y, x=x,
+                     boxes=np.array(boxes).reshape(-1, 4), offsets=offsets,
+                     shape=np.array(shape), **codec)
+            return cls.load(mmap_path)
+        return cls(values, boxes, offsets, shape, names, y, x, **codec)
+
+    @classmethod
+    def from_dataset(cls, ds, mmap_path=None, dtype='float32'):
+        names = list(ds.keys())
+        crops = [crop(ds[name].values) for name in names]
+        return cls.pack(names, [box for box, _ in crops], [part for _, part in crops],
+                        (ds.sizes['y'], ds.sizes['x']),
+                        ds.coords['y'].values, ds.coords['x'].values, mmap_path, dtype)
+
+    @classmethod
+    def from_dense(cls, layers):
+        crops = [crop(layer) for layer in layers.data]
+        return cls.pack(layers.names, [box for box, _ in crops], [part for _, part in crops],
+                        layers.shape, layers.y, layers.x)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        values = np.load(path, mmap_mode=mmap_mode)
+        with np.load(coords_path(path)) as meta:
+            return cls(values, meta['boxes'], meta['offsets'], meta['shape'],
+                       meta['names'], meta['y'], meta['x'],
+                       *(meta[key] if key in meta else None for key in ('scale', 'offset')))
+
+    def composite(self, w, out=None):
+        '''
+        Weighted sum, each farm only added to its box of out
+        '''
+        if out is None:
+            out = np.empty(self.shape, dtype='float32')
+        out.fill(0)
+        tmp = np.empty(np.diff(self.offsets).max(initial=0), dtype='float32')
+        for i in np.flatnonzero(w):
+            self.add(i, w[i], out, tmp)
+        return out
+
+    def add(self, i, c, out, tmp):
+        r0, r1, c0, c1 = self.boxes[i]
+        layer = self.layer(i)
+        factor, constant = self.decoding(i, c)
+        scratch = tmp.reshape(-1)[:layer.size].reshape(layer.shape)
+        np.multiply(layer, factor, out=scratch)
+        if constant:
+            scratch += constant
+        out[r0:r1, c0:c1] += scratch
+
+    def window(self, w, r0, r1, c0, c1):
+        out = np.zeros((r1 - r0, c1 - c0), dtype='float32')
+        for i in np.flatnonzero(w):
+            b0, b1, d0, d1 = self.boxes[i]
+            top, bottom, left, right = max(b0, r0), min(b1, r1), max(d0, c0), min(d1, c1)
+            if top >= bottom or left >= right:
+                continue
+            factor, constant = self.decoding(i, w[i])
+            out[top - r0:bottom - r0, left - c0:right - c0] += \
+                factor * self.layer(i)[top - b0:bottom - b0, left - d0:right - d0] + constant
+        return out
+
+    def column(self, row, col):
+        # 0 for the farms whose box misses the pixel
+        b0, b1, d0, d1 = self.boxes.T
+        inside = np.flatnonzero((b0 <= row) & (row < b1) & (d0 <= col) & (col < d1))
+        at = self.offsets[inside] + (row - b0[inside]) * (d1[inside] - d0[inside]) \
+            + col - d0[inside]
+        values = np.zeros(len(self), dtype='float32')
+        values[inside] = self.values[at]
+        if self.scale is not None:
+            values[inside] = values[inside] * self.scale[inside] + self.offset[inside]
+        return values
+
+
+def crop(layer):
+    '''
+    (r0, r1, c0, c1) box of the non zero values of a (y, x) layer and
+    the flat float32 values in it, NaN counted as 0
+    '''
+    layer = np.nan_to_num(np.asarray(layer, dtype='float32'))
+    rows = np.flatnonzero(layer.any(axis=1))
+    cols = np.flatnonzero(layer.any(axis=0))
+    if len(rows) == 0:
+        return (0, 0, 0, 0), np.empty(0, dtype='float32')
+    r0, r1, c0, c1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    return (r0, r1, c0, c1), np.ascontiguousarray(layer[r0:r1, c0:c1]).ravel()
+
+
+def densify(ds, names, boxes, parts, shape):
+    '''
+    The (y, x) layer of every farm of names: the first ones from their
+    crops, which are released as they go, the others read from ds
+    '''
+    for i, (box, part) in enumerate(zip(boxes, parts)):
+        r0, r1, c0, c1 = box
+        layer = np.zeros(shape, dtype='float32')
+        layer[r0:r1, c0:c1] = part.reshape(r1 - r0, c1 - c0)
+        parts[i] = None
+        yield layer
+    for name in names[len(boxes):]:
+        yield ds[name].values
+
+
+def from_dataset(ds, mmap_path=None, max_fill=0.25, dtype='float32'):
+    '''
+    Sparse layers when the farm boxes cover less than max_fill of the
+    grid on average, else the dense tensor. The cropped layers are kept
+    in memory until packed, the dense tensor is built as soon as they
+    exceed max_fill of its size, from the crops already read and the
+    farms not read yet.
+    '''
+    names = list(ds.keys())
+    shape = (ds.sizes['y'], ds.sizes['x'])
+    budget = max_fill * len(names) * shape[0] * shape[1]
+    boxes, parts, size = [], [], 0
+    for name in names:
+        box, part = crop(ds[name].values)
+        size += part.size
+        boxes.append(box)
+        parts.append(part)
+        if size > budget:
+            return FarmLayers.from_layers(names, densify(ds, names, boxes, parts, shape),
+                                          shape, ds.coords['y'].values, ds.coords['x'].values,
+                                          mmap_path, dtype)
+    return SparseFarmLayers.pack(names, boxes, parts, shape, ds.coords['y'].values,
+                                 ds.coords['x'].values, mmap_path, dtype)
+
+
+def load(path, mmap_mode='r'):
+    '''
+    Reopen the layers written by from_dataset, sparse or dense
+    '''
+    with np.load(coords_path(path)) as meta:
+        sparse = 'boxes' in meta
+    cls = SparseFarmLayers if sparse else FarmLayers
+    return cls.load(path, mmap_mode)
+
+
+def coords_path(path):
+    return os.path.splitext(path)[0] + '.coords.npz'
+
+
+def accuracy(reference, layers, n=20, seed=0):
+    '''
+    Error of the composites of layers against the reference layers for
+    n random scenarios: the largest absolute error, the same relative to
+    the maximum of the composite, and the largest relative error of the
+    pixels above 1% of that maximum
+    '''
+    rng = np.random.default_rng(seed)
+    worst = {'max_error': 0., 'max_error_of_max': 0., 'max_relative_error': 0.}
+    for _ in range(n):
+        w = (rng.uniform(0, 2, len(reference)) * (rng.random(len(reference)) < 0.7))
+        w = w.astype('float32')
+        expected = reference.composite(w).astype('float64')
+        error = np.abs(layers.composite(w) - expected)
+        top = expected.max()
+        if top <= 0:
+            continue
+        visible = expected > 0.01 * top
+        for key, value in (('max_error', error.max()),
+                           ('max_error_of_max', error.max() / top),
+                           ('max_relative_error', (error[visible] / expected[visible]).max())):
+            worst[key] = max(worst[key], float(value))
+    return worst
+
+
+if __name__ == '__main__':
+    # python layers.py <master.zarr> [float16 uint16]
+    import gcsfs
+    from xarray import open_zarr
+    fs = gcsfs.GCSFileSystem()
+    ds = open_zarr(fs.get_mapper(sys.argv[1])).drop_vars('spatial_ref', errors='ignore')
+    reference = from_dataset(ds)
+    print('float32 {}: {:.1f} MB'.format(type(reference).__name__, reference.nbytes / 2**20))
+    for dtype in sys.argv[2:] or DTYPES[1:]:
+        layers = from_dataset(ds, dtype=dtype)
+        print('{}: {:.1f} MB, {}'.format(dtype, layers.nbytes / 2**20,
+                                         accuracy(reference, layers)))
@@ -12,63 +12,163 @@
 #
 # Copyright 2022, Julien Moreau, Plastic@Bay CIC
 
-import googlecloudprofiler
-
-# Profiler initialization. It starts a daemon thread which continuously
-# collects and uploads profiles. Best done as early as possible.
-try:
-    # service and service_version can be automatically inferred when
-    # running on App Engine. project_id must be set if not running
-    # on GCP.
-    googlecloudprofiler.start(verbose=3)
-except (ValueError, NotImplementedError) as exc:
-    print(exc)  # Handle errors here
-
-import gcsfs
-from  xarray import open_zarr
-from rasterio.enums import Resampling
-from google.cloud import storage
+import json
+import os
+import threading
+import time
+from startup import once, Warmup, StartupProfile
+
+# PROFILE_STARTUP=1 reports the import cost of each module and the
+# duration of each startup phase at the end of the warmup
+profile = StartupProfile(os.environ.get('PROFILE_STARTUP') == '1')
+profile.track_imports()
+
+def start_profiler():
+    # Profiler initialization. It starts a daemon thread which continuously
+    # collects and uploads profiles. Imported in a thread so the grpc
+    # stack does not delay the startup.
+    import googlecloudprofiler
+    try:
+        # service and service_version can be automatically inferred when
+        # running on App Engine. project_id must be set if not running
+        # on GCP.
+        googlecloudprofiler.start(verbose=3)
+    except (ValueError, NotImplementedError) as exc:
+        print(exc)  # Handle errors here
+
+threading.Thread(target=start_profiler, daemon=True).start()
+
+# gcsfs, xarray, zarr and colorcet are imported on first use
 import numpy as np
-import datashader as DS
 import plotly.graph_objects as go
-from colorcet import fire, bmy
-from datashader import transfer_functions as tf
-from datetime import datetime, timedelta
 import os.path
+from uuid import uuid4
 import dash
+import flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dash import dcc as dcc
+from dash import Patch
+from dash import dash_table
 from dash import html as html
-from dash.dependencies import Input, Output, State, MATCH, ALL
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 from dash_bootstrap_templates import ThemeSwitchAIO, load_figure_template
 
+# component library, it has to be imported before the first request
+# for Dash to serve its javascript
 import dash_daq as daq
 
-from flask_caching import Cache
+
+from registry import LayerRegistry, store_token
+from compositor import Compositor
+from tiles import TILE_SIZE, TileGrid, grid_corners, render_tile, tile_pixel_size, tiles_covering
+from chunk_cache import CachedStore
+from progress import load_all
+from images import IMAGE_FORMATS, encode_image, content_hash, not_modified, image_response
+from render_cache import RenderCache, canonical_scenario, composite_key
+from metrics import Metrics
+from shading import shade as lut_shade
+from frames import Prefetcher, daily_composite, day_marks
+from windows import window_column, window_composite, window_index
+from layers import FarmLayers
+from farms import FarmRegistry
+
+profile.mark('imports')
 
 #from callbacks import callbacks
 
-def get_coordinates(agg):
-    coords_lat, coords_lon = agg.coords['y'].values, agg.coords['x'].values
-    coordinates=[[coords_lon[0], coords_lat[0]],
-                       [coords_lon[-1], coords_lat[0]],
-                       [coords_lon[-1], coords_lat[-1]],
-                       [coords_lon[0], coords_lat[-1]]]
-    return coordinates
+def shade(arr, span, cmp, origin='lower'):
+    '''
+    Colour an aggregated composite, pixels <= 0 are transparent
+    '''
+    with metrics.stage('shading') as info:
+        img=lut_shade(arr, span, cmp, origin)
+        info['bytes']=img.width*img.height*len(img.getbands())
+    return img
+
+def mk_tile(compositor, coordinates, scenario, z, x, y):
+    '''
+    Create one XYZ tile of the raster of a scenario
+    '''
+    return shade(aggregate_tile(compositor, coordinates, scenario, z, x, y),
+                 scenario['span'], palette(scenario['cmap']), origin='upper')
+
+def cached_composite(key, shape, build):
+    '''
+    Masked float32 composite of shape kept in composite_cache under key,
+    build() makes it when it is not there. Read-only.
+    '''
+    data=composite_cache.get(key)
+    if data is not None:
+        return np.frombuffer(data, dtype='float32').reshape(shape)
+    arr=build()
+    composite_cache.set(key, arr.tobytes())
+    return arr
+
+def aggregate(compositor, scenario, session=None):
+    '''
+    Masked composite of a scenario, kept in composite_cache so that a
+    new span or palette only shades it again. Read-only.
+    '''
+    if scenario.get('window'):
+        return window_aggregate(scenario)
+    layers=compositor.layers
+    return cached_composite(composite_key(scenario, layers.shape), layers.shape,
+                            lambda: compositor.render(scenario['names'], scenario['coeff'],
+                                                      session, timed=metrics.stage))
+
+def aggregate_tile(compositor, coordinates, scenario, z, x, y):
+    '''
+    Masked composite of one XYZ tile of a scenario, cached like aggregate.
+    It is cut from the whole composite when there is one, e.g. the
+    session composite built by redraw, else only the farm layers under
+    the tile are summed.
+    '''
+    layers=compositor.layers
+    whole_key=composite_key(scenario, layers.shape)
+
+    def build():
+        if scenario.get('window'):
+            whole, corners=window_aggregate(scenario), window_grid()
+        else:
+            whole, corners=composite_cache.get(whole_key), coordinates
+            if whole is not None:
+                whole=np.frombuffer(whole, dtype='float32').reshape(layers.shape)
+        if whole is not None:
+            source=FarmLayers(whole[None], ['composite'], layers.y, layers.x)
+            Coeff=np.ones(1, dtype='float32')
+        else:
+            source=layers
+            with metrics.stage('coefficient build') as info:
+                Coeff=layers.coefficients(scenario['names'], scenario['coeff'])
+                info['bytes']=Coeff.nbytes
+        grid=TileGrid(corners[::-1], source.shape)
+        with metrics.stage('tile composite') as info:
+            arr=render_tile(source, Coeff, grid, z, x, y)
+            info['bytes']=arr.nbytes
+        return arr
+
+    return cached_composite('{}-{}-{}-{}'.format(whole_key, z, x, y), (TILE_SIZE, TILE_SIZE),
+                            build)
+
+def cached_map(name, persist=True):
+    '''
+    zarr mapping of a bucket store read through the local chunk cache,
+    or straight from the bucket if not persist
+    '''
+    return CachedStore(gcs_fs(), name, chunk_cache if persist else None)
+
+def gcs_fs():
+    import gcsfs
+    return gcsfs.GCSFileSystem()
 
-def mk_img(ds_host, name_list, span, Coeff,cmp):
+def palette(name):
     '''
-    Create an image to project on mabpox
+    colorcet palette by name
     '''
-    print('making raster...')
-    subds=ds_host[name_list]
-    for i in range(len(name_list)):
-        subds[name_list[i]].values *=Coeff[i]
-    arr= subds.to_stacked_array('v', ['y', 'x']).sum(dim='v')
-    print('data stacked')
-    return tf.shade(arr.where(arr>0).load(),
-                    cmap=cmp, how='linear',
-                    span=span).to_pil()
+    import colorcet
+    return getattr(colorcet, name)
 
 def get_farm_data(npfile):
     '''
@@ -82,8 +182,9 @@ def get_farm_data(npfile):
 
 #####################TAB 1 ###########################
 
-def make_base_figure(farm_loc,computed_farms, center_lat, center_lon, span, cmp, template):
+def make_base_figure(farms, center_lat, center_lon, span, cmp, template):
     print('Making figure ...')
+    pending=~farms.computed
     fig= go.Figure()
     fig.add_trace(go.Scatter(x=[None], y=[None],marker=go.scatter.Marker(
                         colorscale=cmp,
@@ -95,28 +196,28 @@ def make_base_figure(farm_loc,computed_farms, center_lat, center_lon, span, cmp,
                     name='only_scale',
                     showlegend=False),)
     fig.add_trace(go.Scattermapbox(
-                        lon=farm_loc[~computed_farms][:,-1],
-                        lat=farm_loc[~computed_farms][:,-2],
-                        text=farm_loc[~computed_farms][:,0],
+                        lon=farms.lon[pending],
+                        lat=farms.lat[pending],
+                        text=farms.name[pending],
                         hovertemplate="<b>%{text}</b><br><br>" +
                                         "Biomass: %{marker.size:.0f} tons<br>",
                         name="Awaiting completion farm",
                         hoverinfo='all',
                         marker=dict(color='#5bc0de',
-                                size=farm_loc[~computed_farms][:,1].astype('int'),
+                                size=farms.biomass[pending],
                                 sizemode='area',
                                 sizeref=10,
                                 showscale=False
                         )
                 ))
     fig.add_trace(go.Scattermapbox(
-                        lon=farm_loc[computed_farms][:,-1],
-                        lat=farm_loc[computed_farms][:,-2],
-                        text=farm_loc[computed_farms][:,0],
+                        lon=farms.lon[farms.computed],
+                        lat=farms.lat[farms.computed],
+                        text=farms.name[farms.computed],
                         hovertemplate="<b>%{text}</b><br><br>" +
                                         "Biomass: %{marker.size:.0f} tons<br>",
                         marker=dict(color='#62c462',
-                                size=farm_loc[computed_farms][:,1].astype('int'),
+                                size=farms.biomass[farms.computed],
                                 sizemode='area',
                                 sizeref=10,
                                 showscale=False
@@ -143,6 +244,37 @@ def make_base_figure(farm_loc,computed_farms, center_lat, center_lon, span, cmp,
                     ))
     return fig
 
+def mk_query_grid(corners, n):
+    '''
+    Invisible points over the overlay, mapbox only reports the clicks
+    on a trace. They take the hover from the farms, so the grid is only
+    added while the query mode is on, as the trace 4.
+    corners are in the mapbox order, see tiles.TileGrid
+    '''
+    (west, north), _, (east, south), _ = corners
+    lon, lat=np.meshgrid(np.linspace(west, east, n), np.linspace(south, north, n))
+    return go.Scattermapbox(lon=lon.ravel().round(4), lat=lat.ravel().round(4),
+                            mode='markers', marker=dict(size=8, opacity=0),
+                            hoverinfo='none', name='query', showlegend=False)
+
+def mk_point_query(result):
+    '''
+    Density at the clicked point and the farms contributing to it
+    '''
+    if result is None:
+        return html.P('Turn the point query on and click the map to see which '
+                      'farms the lice come from')
+    header=html.P('{:.3f} copepodid/sqm at {:.4f}°N {:.4f}°E'.format(
+        result['density'], result['lat'], result['lon']))
+    if not result['farms']:
+        return header
+    rows=[html.Tr([html.Td(farm['name']), html.Td('{:.3f}'.format(farm['contribution'])),
+                   html.Td('{:.0%}'.format(farm['share']))])
+          for farm in result['farms'][:10]]
+    return html.Div([header, dbc.Table(
+        [html.Thead(html.Tr([html.Th('Farm'), html.Th('Density'), html.Th('Share')])),
+         html.Tbody(rows)], size='sm', striped=True)])
+
 def mk_map_pres(start, end):
     return dbc.Row([
         dbc.Col([
@@ -162,14 +294,41 @@ def mk_map_pres(start, end):
             dbc.CardBody([
                 dbc.Alert('The size of the disks is proportional to the biomass', color='primary'),
                 dbc.Alert('Hover a farm for more information', color='secondary'),
-                dbc.Alert('Colorscale is the average density of copepodid per sqm from {} to {}'.format(start,end), color='primary'),
+                dbc.Alert('Colorscale is the average density of copepodid per sqm from {} to {}, or the density of the day picked under the map'.format(start,end), color='primary'),
                 dbc.Alert('A density of 2 copepodid/sqm/day leads to a 30% mortality of wild smolts each day', color='warning')
             ])
             )
         ],width=9),
     ]),
 
-def tab1_layout(farm_loc,computed_farms,center_lat, center_lon, span, cmp, template):
+def mk_day_player(days):
+    '''
+    Day slider under the map, Play steps through the days
+    '''
+    return dbc.Row([
+        dbc.Col(dbc.Button('Play', id='day-play', n_clicks=0, size='sm',
+                           disabled=not len(days)), width=1),
+        dbc.Col(dcc.Slider(id='day-slider', min=-1, max=max(len(days)-1, 0), step=1,
+                           value=-1, marks=day_marks(days), disabled=not len(days)),
+                width=11),
+        dcc.Interval(id='day-player', interval=700, disabled=True),
+    ], align='center')
+
+def mk_window_picker(days):
+    '''
+    Interval of the average map, any window of the cumulative store
+    '''
+    return dbc.Row([
+        dbc.Col(html.Span('Mapped interval'), width='auto'),
+        dbc.Col(dcc.DatePickerRange(id='window-picker', start_date=start, end_date=end,
+                                    min_date_allowed=days[0] if days else None,
+                                    max_date_allowed=days[-1] if days else None,
+                                    display_format='YYYY-MM-DD',
+                                    disabled=not len(days))),
+    ], align='center')
+
+def tab1_layout(farms,center_lat, center_lon, span, cmp, template, days=(), windows=()):
+    fig=make_base_figure(farms, center_lat, center_lon, span, cmp, template)
     return dbc.Card([
     dbc.CardHeader('Clyde area'),
     dbc.CardBody([
@@ -181,9 +340,13 @@ def tab1_layout(farm_loc,computed_farms,center_lat, center_lon, span, cmp, templ
             dbc.Row([
                 dcc.Graph(
                     id='heatmap',
-                    figure=make_base_figure(farm_loc,computed_farms,
-                                    center_lat, center_lon, span, cmp, template)
+                    figure=fig
                     ),
+                mk_day_player(days),
+                mk_window_picker(windows),
+                daq.BooleanSwitch(id='query-mode', on=False, label='Point query',
+                                  labelPosition='right'),
+                html.Div(mk_point_query(None), id='point-query'),
                 dcc.Loading(
                     id='figure_loading',
                     children=[html.Div(id='heatmap_output'),],
@@ -197,45 +360,53 @@ def tab1_layout(farm_loc,computed_farms,center_lat, center_lon, span, cmp, templ
     ])
 ################# tab2 ###########################3
 
-def mk_accordion_item(name, farm_loc, i, marks_biomass, marks_lice):
-    data=farm_loc[farm_loc[:,0]==name][0]
-    item=dbc.Row([
-            dbc.Col([
-                daq.BooleanSwitch(
-                    id={'type':'switch','id':i},
-                    on=True,
-                    label="Toggle farm on/off",
-                    labelPosition="top"
-                    )],
-                width=3),
-            dbc.Col([
-                html.H3('Modelled Biomass {} tons'.format(data[1])),
-                html.H3('Tune Farm biomass:'),
-                dcc.Slider(
-                    id={'type':'biomass_slider','id':i},
-                    step=0.05,
-                    marks=marks_biomass,
-                    value=1,
-                    included=False,
-                    tooltip={"placement": "bottom"},
-                    disabled=False
-                    ),
-                html.H3('Tune lice infestation:'),
-                html.P('Unit is lice/fish'),
-                dcc.Slider(
-                    id={'type':'lice_slider','id':i},
-                    step=0.05,
-                    marks=marks_lice,
-                    value=0.5,
-                    included=False,
-                    tooltip={"placement": "bottom"},
-                    disabled=False,
-                    )],
-            width=8)
-        ], align='center')
-    return item
-
-def tab2_layout(Filtered_names,farm_loc):
+def farm_rows(farms):
+    '''
+    Rows of the farm table: the processed farms with the defaults of
+    the global sliders
+    '''
+    return [{'farm': farms.name[row], 'modelled': round(farms.biomass[row]),
+             'on': 'on', 'biomass': 1, 'lice': 0.5} for row in farms.processed]
+
+def mk_farm_table(farms):
+    '''
+    Editor of the parameters of every processed farm. Only the rows on
+    screen are drawn, the table is read in the browser into the
+    farm-coefficients vectors that redraw receives.
+    '''
+    rows=farm_rows(farms)
+    number=dict(type='numeric', editable=True,
+                on_change={'action':'coerce', 'failure':'default'})
+    return html.Div([
+        dcc.Store(id='farm-coefficients', data={
+            'on': [True]*len(rows), 'biomass': [1]*len(rows), 'lice': [0.5]*len(rows)}),
+        dash_table.DataTable(
+            id='farm-table',
+            data=rows,
+            columns=[
+                dict(id='farm', name='Farm', editable=False),
+                dict(id='modelled', name='Modelled biomass (tons)', type='numeric',
+                     editable=False),
+                dict(id='on', name='Farm on/off', presentation='dropdown', editable=True),
+                dict(id='biomass', name='Biomass compared to model',
+                     validation={'default':1}, **number),
+                dict(id='lice', name='Lice infestation (lice/fish)',
+                     validation={'default':0.5}, **number),
+            ],
+            dropdown={'on': {'options': [{'label':v, 'value':v} for v in ('on', 'off')],
+                             'clearable': False}},
+            style_data_conditional=[{'if': {'filter_query': '{on} = "off"'},
+                                     'opacity': 0.5}],
+            sort_action='native',
+            filter_action='native',
+            page_action='none',
+            virtualization=True,
+            fixed_rows={'headers': True},
+            style_table={'height': 400, 'overflowY': 'auto'},
+            )
+        ])
+
+def tab2_layout(farms):
     marks_biomass={
         0.1:'10%',
         0.25:'25%',
@@ -371,12 +542,7 @@ def tab2_layout(Filtered_names,farm_loc):
         dbc.Card([
             dbc.CardHeader('Modify individual farm parameters'),
             dbc.CardBody([
-                dbc.Accordion(
-                    [dbc.AccordionItem([
-                        mk_accordion_item(Filtered_names[i],farm_loc, i, marks_biomass, marks_lice)],
-                                    title=Filtered_names[i]) for i in range(len(Filtered_names))],
-                        start_collapsed=True,
-                    )
+                mk_farm_table(farms)
                 ])
             ])
         ])
@@ -386,22 +552,38 @@ def tab2_layout(Filtered_names,farm_loc):
 ################### TAB 3 #########################
 
 
+def reduce_trajectory(path):
+    '''
+    Total number of copepodids of a farm at each time step
+    '''
+    from xarray import open_zarr
+    with open_zarr(cached_map(path, persist=False)) as ds:
+        return ds.time.values, ds.copepodid.sum(axis=1).values
+
+def load_curves():
+    '''
+    [(farm, time, copepodid)] from the summary sidecar kept up to date
+    by summaries.py, or reduced from the trajectories if there is none yet
+    '''
+    fs= gcs_fs()
+    if fs.exists(summary_name):
+        from summaries import read_summaries
+        store=cached_map(summary_name)
+        store.prefetch()
+        return read_summaries(store)
+    file_list=sorted(fs.ls('sealice_db/Clyde_trajectories/', detail=False))
+    curves, errors=load_all(file_list, reduce_trajectory)
+    for path, err in errors.items():
+        print('cannot open: {} ({})'.format(path, err))
+    return [(path.split('/')[-1], time, copepodid) for path, (time, copepodid) in curves]
+
 def mk_curves(start, end):
-    fs= gcsfs.GCSFileSystem()
-    file_list=fs.ls('sealice_db/Clyde_trajectories/')
     fig_p=go.Figure()
-    for i in range(len(file_list)):
-        gcs=gcsfs.mapping.GCSMap(file_list[i]+'/',
-                                gcs=fs, check=True, create=False)
-        try:
-            with open_zarr(gcs) as ds:
-                fig_p.add_trace(go.Scatter(x=ds.time,
-                                       y=ds.copepodid.sum(axis=1).values,
-                                       name=file_list[i].split('/')[-1],
-                                       mode='lines', stackgroup='one' ))
-        except:
-            print('cannot open:')
-            print(file_list[i])
+    for name, time, copepodid in load_curves():
+        fig_p.add_trace(go.Scatter(x=time,
+                                   y=copepodid,
+                                   name=name,
+                                   mode='lines', stackgroup='one' ))
     fig_p.add_vrect(x0=start, x1=end,
                     annotation_text="mapped time interval",
                     annotation_position="top left",
@@ -428,35 +610,55 @@ def tab3_layout(start, end):
 ############# VARIABLES ##########################33
 span=[0,2] # value extent
 resolution_M=[50,100,200]
+# multiscale store built by pyramid.py from the 50m master.zarr
+pyramid_name='sealice_db/aggregations_{}m/pyramid.zarr'.format(resolution_M[0])
+# per farm (time, total copepodid) series written by summaries.py
+summary_name='sealice_db/Clyde_trajectories_summary.zarr'
+# master.zarr like layers with a time dimension chunked by day
+daily_name='sealice_db/aggregations_{}m/daily.zarr'
+frames_ahead=3 # daily frames rendered ahead of the one displayed
+# running sum over time of the daily layers, written by windows.py
+cumsum_name='sealice_db/aggregations_{}m/cumsum.zarr'
+# seconds between two checks of the bucket stores for a new version
+store_check_interval=300
+# storage of the farm layers: 'float16' or 'uint16' halve their memory,
+# python layers.py <master.zarr> reports the error it makes on the maps
+layer_dtype='float32'
+query_grid=80 # clickable points along each side of the overlay
 center_lat,center_lon=55.7,-5.23
 start, end = "2018-05-06", "2018-05-30"
 
 ######## fetch data #######
 
-if 'All_names' not in globals():
+# deferred until the first request or the warmup
+farm_file='/tmp/modelled_farms.npy'
+coord_file='/tmp/master_coordinates.npy'
+
+@once
+@profile.phase('data fetch')
+def farm_data():
+    '''
+    FarmRegistry of all the farms, the computed ones those of the
+    layers of the 50m store
+    '''
+    from xarray import open_zarr
     print('loading dataset')
-    uri='gs://sealice_db/aggregations_{}m/master.zarr'.format(resolution_M[1])
-    fs = gcsfs.GCSFileSystem()
     gcs_bucket_name ='sealice_db/aggregations_{}m/master.zarr'.format(resolution_M[0])
-    gcsmap = gcsfs.mapping.GCSMap(gcs_bucket_name, gcs=fs, check=True, create=False)
-    super_ds=open_zarr(gcsmap).drop('spatial_ref')
-    All_names=np.array(list(super_ds.keys()))
-
-if 'farm_loc' not in globals():
-    npfile='/tmp/modelled_farms.npy'
-    if not os.path.isfile(npfile):
-        get_farm_data(npfile)
-    farm_loc=np.load(npfile)
+    super_ds=open_zarr(cached_map(gcs_bucket_name, persist=False)).drop('spatial_ref')
+    if not os.path.isfile(farm_file):
+        get_farm_data(farm_file)
+    farm_loc=np.load(farm_file)
     print('Farm loaded')
+    return FarmRegistry.from_array(farm_loc, list(super_ds.keys()))
 
-computed_farms=(farm_loc[:,0][:,None]==np.array(All_names)).any(axis=1)
-Coeff=np.ones(len(All_names[computed_farms]))
-
-coord_file='/tmp/master_coordinates.npy'
-if not os.path.isfile(coord_file):
-    get_farm_data(coord_file)
-coordinates=np.load(coord_file)
-print('Coordinates loaded')
+@once
+@profile.phase('coordinates fetch')
+def master_coordinates():
+    if not os.path.isfile(coord_file):
+        get_farm_data(coord_file)
+    coordinates=np.load(coord_file)
+    print('Coordinates loaded')
+    return coordinates
 
 ######  manage themes #####
 def mk_colorscale(cmp):
@@ -479,10 +681,24 @@ template_theme2 = "sandstone"
 load_figure_template([template_theme1,template_theme2])
 url_theme1=dbc.themes.SLATE
 url_theme2=dbc.themes.SANDSTONE
-cmp1= fire
-cmp2= bmy
+# colorcet palettes
+cmp1= 'fire'
+cmp2= 'bmy'
 carto_style1="carto-darkmatter"
 carto_style2="carto-positron"
+# theme name in the browser: (toggle value, template, map style, palette)
+themes={'dark':(True, template_theme1, carto_style1, cmp1),
+        'light':(False, template_theme2, carto_style2, cmp2)}
+
+def theme_data():
+    '''
+    Layout properties of each theme, swapped in the browser by
+    assets/themes.js when the theme is toggled
+    '''
+    return {name:{'template':mk_template(template).to_plotly_json(),
+                  'carto_style':style,
+                  'colorscale':mk_colorscale(palette(cmp)).tolist()}
+            for name, (_, template, style, cmp) in themes.items()}
 dbc_css = (
     "https://cdn.jsdelivr.net/gh/AnnMarieW/dash-bootstrap-templates@V1.0.1/dbc.min.css"
 )
@@ -491,24 +707,464 @@ app = dash.Dash(__name__,
                 external_stylesheets=[url_theme1],#, dbc_css
                 meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1"}])
 server=app.server
-cache = Cache(app.server, config={
-    'CACHE_TYPE': 'filesystem',
-    'CACHE_DIR': '/tmp'
-})
-timeout = 300
+# App Engine terminates TLS in front of gunicorn: the urls of the tiles
+# and images sent to the browser take the scheme from X-Forwarded-Proto
+# so that an https page does not load them over http
+server.wsgi_app=ProxyFix(server.wsgi_app, x_proto=1, x_host=1)
+# The F4_1G instance has 1 GB for the workers and /tmp, which is RAM.
+# The caches below share cache_budget of it: 7/8 on disk in /tmp for
+# the instance, 1/8 in the memory of each worker (one by default). The
+# rest goes to the workers themselves and the layers in /tmp/layers.
+cache_budget = 320 * 2**20
+# rendered images and tiles, in memory and in /tmp shared by the workers
+render_cache = RenderCache('/tmp/render_cache', max_memory=cache_budget // 32,
+                           max_disk=cache_budget // 4)
+# float32 composites before shading, whole grids and tiles
+composite_cache = RenderCache('/tmp/composite_cache', max_memory=cache_budget * 3 // 32,
+                              max_disk=cache_budget * 3 // 8)
+# local copy of the chunks of the bucket stores read repeatedly,
+# one size cap for all of them
+chunk_cache = RenderCache('/tmp/chunks', max_memory=0, max_disk=cache_budget // 4)
+
+def register_scenario(key, params):
+    '''
+    Keep the params of a scenario for the urls of its tiles, frames,
+    queries and images, a small JSON entry of render_cache
+    '''
+    render_cache.set('scenario/{}.json'.format(key), json.dumps(params).encode())
+
+def scenario_params(key):
+    '''
+    Params of a registered scenario, None if unknown or evicted
+    '''
+    data=render_cache.get('scenario/{}.json'.format(key))
+    return None if data is None else json.loads(data)
+use_tiles = True # serve the raster as XYZ tiles rather than one image
+image_format = 'png' # or 'webp'
+# render stages timings served on /metrics, SLOW_REQUEST_SECONDS logs
+# the breakdown of the requests slower than that
+metrics = Metrics(slow_request=float(os.environ.get('SLOW_REQUEST_SECONDS', 0)))
+
+@server.before_request
+def reset_request_timer():
+    flask.g.t0=time.perf_counter()
+    metrics.pop_elapsed()
+
+@server.after_request
+def record_serialisation(response):
+    '''
+    Time of a Dash callback request spent outside the callbacks,
+    mostly (de)serialising the figures it carries
+    '''
+    if flask.request.path.endswith('_dash-update-component'):
+        elapsed=time.perf_counter()-flask.g.t0
+        metrics.observe(metrics.stages, 'figure serialisation',
+                        max(elapsed-metrics.pop_elapsed(), 0),
+                        response.content_length or 0)
+    return response
+
+@server.route('/metrics')
+def prometheus_metrics():
+    '''
+    Metrics of this worker in the Prometheus text format
+    '''
+    stats={'render':render_cache.stats(), 'composite':composite_cache.stats(),
+           'chunk':chunk_cache.stats()}
+    hits, misses, memory={}, {}, {}
+    for name, stat in stats.items():
+        for tier in ('memory', 'disk'):
+            hits['cache="{}",tier="{}"'.format(name, tier)]=stat['hits_'+tier]
+        misses['cache="{}"'.format(name)]=stat['misses']
+        memory['cache="{}"'.format(name)]=stat['memory_bytes']
+    extra=[
+        ('sealice_render_cache_hits_total', 'Render cache hits', 'counter', hits),
+        ('sealice_render_cache_misses_total', 'Render cache misses', 'counter', misses),
+        ('sealice_render_cache_memory_bytes', 'Bytes in the memory tier', 'gauge', memory),
+    ]
+    return flask.Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
 
 @server.route('/_ah/warmup')
 def warmup():
     """Warm up an instance of the app."""
-    return "it is warm"
-    # Handle your warmup logic here, e.g. set up a database connection pool
+    # the caches are filled in the background, see warmup_routine
+    return flask.jsonify(warmup_routine.start())
+
+@server.route('/tiles/<scenario>/<int:z>/<int:x>/<int:y>.<fmt>')
+@metrics.request('tile')
+def tile(scenario, z, x, y, fmt):
+    '''
+    Render one tile of a scenario registered by redraw
+    '''
+    if fmt not in IMAGE_FORMATS:
+        flask.abort(404)
+    # the scenario key is a hash of its parameters so tiles never change
+    etag='{}-{}-{}-{}.{}'.format(scenario, z, x, y, fmt)
+    response=not_modified(etag)
+    if response is not None:
+        return response
+    data=tile_bytes(scenario, z, x, y, fmt)
+    if data is None:
+        flask.abort(404)
+    return image_response(data, fmt, etag)
+
+def tile_level(r, z):
+    '''
+    Resolution to render the tiles of zoom z from: the coarsest level
+    still as fine as their pixels, never finer than the resolution r
+    picked on the dashboard
+    '''
+    from pyramid import pick_level
+    res=resolutions()
+    level=pick_level([{'resolution': m} for m in res], tile_pixel_size(z, center_lat))
+    return max(r, res.index(level['resolution']))
+
+def present_farms(params, layers):
+    '''
+    params without the farms missing from layers, the stores of the
+    other resolutions may not have every farm of the dashboard
+    '''
+    keep=[i for i, name in enumerate(params['names']) if name in layers.index]
+    if len(keep)==len(params['names']):
+        return params
+    return dict(params, names=[params['names'][i] for i in keep],
+                coeff=[params['coeff'][i] for i in keep])
+
+def cached_image(key, fmt, render):
+    '''
+    Encoded image kept in render_cache under key, render() makes the
+    image to encode when it is not there. None if render() gives None.
+    '''
+    data=render_cache.get(key)
+    if data is None:
+        img=render()
+        if img is None:
+            return None
+        with metrics.stage('encoding') as info:
+            data=encode_image(img, fmt)
+            info['bytes']=len(data)
+        render_cache.set(key, data)
+    return data
+
+def tile_bytes(scenario, z, x, y, fmt):
+    '''
+    Encoded tile from the render cache or rendered, None for an
+    unknown scenario
+    '''
+    def render():
+        params=scenario_params(scenario)
+        if params is None:
+            return None
+        if not params.get('window'):
+            # the zoomed out tiles are rendered from a coarser level
+            level=tile_level(params['r'], z)
+            params=dict(params, r=level, version=data_version(level))
+        with metrics.stage('dataset fetch'):
+            compositor, coordinates=get_compositor(params['r'])
+        if not params.get('window'):
+            params=present_farms(params, compositor.layers)
+        return mk_tile(compositor, coordinates, params, z, x, y)
+
+    return cached_image('{}-{}-{}-{}.{}'.format(scenario, z, x, y, fmt), fmt, render)
+
+def heatmap_bytes(params, key, session=None):
+    '''
+    Encoded image of a whole scenario from the render cache or rendered
+    '''
+    def render():
+        with metrics.stage('dataset fetch'):
+            compositor, _=get_compositor(params['r'])
+        return shade(aggregate(compositor, params, session), params['span'],
+                     palette(params['cmap']))
+
+    return cached_image('{}.{}'.format(key, image_format), image_format, render)
+
+def raster_layer(params, key, session=None, eager=True):
+    '''
+    Mapbox layer of a registered scenario. The whole image is rendered
+    now if eager, else on its first request
+    '''
+    if use_tiles:
+        if eager:
+            # the tiles are then cut from the session composite, only
+            # the farms changed since the last redraw are summed again
+            with metrics.stage('dataset fetch'):
+                compositor, _=get_compositor(params['r'])
+            aggregate(compositor, params, session)
+        return {"below": 'traces',
+                "sourcetype": "raster",
+                "source": [flask.request.host_url+
+                    'tiles/{}/{{z}}/{{x}}/{{y}}.{}'.format(key, image_format)]}
+    if eager:
+        source=store_img(key, heatmap_bytes(params, key, session))
+    else:
+        source='{}scenarios/{}.{}'.format(flask.request.host_url, key, image_format)
+    if params.get('window'):
+        coordinates=window_grid()
+    else:
+        _, coordinates=get_compositor(params['r'])
+    return {"below": 'traces',
+            "sourcetype": "image",
+            "source": source,
+            "coordinates": coordinates[::-1].tolist()}
+
+@server.route('/scenarios/<key>.<fmt>')
+@metrics.request('scenario image')
+def scenario_image(key, fmt):
+    '''
+    Whole image of a scenario registered by redraw, rendered on demand
+    '''
+    if fmt!=image_format:
+        flask.abort(404)
+    response=not_modified(key)
+    if response is not None:
+        return response
+    params=scenario_params(key)
+    if params is None:
+        flask.abort(404)
+    return image_response(heatmap_bytes(params, key), fmt, key)
+
+def frame_layer(key, day):
+    '''
+    Mapbox layer of the frame of a day of a registered scenario
+    '''
+    return {"below": 'traces',
+            "sourcetype": "image",
+            "source": '{}frames/{}/{}.{}'.format(flask.request.host_url, key, day, image_format),
+            "coordinates": window_grid()[::-1]}
+
+time_stores={}
+def open_time_store(name, r):
+    '''
+    Time resolved layers of resolution r, None if the store is missing.
+    Like the layer registry, the version of the store is checked every
+    store_check_interval seconds and the store opened again when it was
+    updated with new days.
+    '''
+    from xarray import open_zarr
+    key=name.format(resolution_M[r])
+    entry=time_stores.get(key)
+    now=time.monotonic()
+    if entry is not None and now-entry[2]<store_check_interval:
+        return entry[0]
+    version=store_token(gcs_fs(), key)
+    if entry is not None and (version is None or version==entry[1]):
+        # unchanged, or the bucket did not answer
+        ds, version=entry[0], entry[1]
+    elif version is None:
+        ds=None
+    else:
+        store=cached_map(key)
+        store.prefetch(['time', 'y', 'x'])
+        ds=open_zarr(store).drop_vars('spatial_ref', errors='ignore')
+    time_stores[key]=ds, version, now
+    return ds
+
+def open_daily(r):
+    return open_time_store(daily_name, r)
+
+def open_cumsum(r):
+    return open_time_store(cumsum_name, r)
+
+def store_days(ds):
+    '''
+    Days of a time resolved store as YYYY-MM-DD, none without the store
+    '''
+    if ds is None:
+        return []
+    return [str(day) for day in np.datetime_as_string(ds.time.values, unit='D')]
+
+def daily_times():
+    return store_days(open_daily(1))
+
+def window_times():
+    return store_days(open_cumsum(1))
+
+def window_grid():
+    '''
+    Corners of the grid of the time stores, daily and cumulative, in
+    the order of master_coordinates: it is their grid at every resolution
+    '''
+    return master_coordinates()
+
+def window_aggregate(params):
+    '''
+    Masked composite of the average over the window of a scenario,
+    cached like aggregate
+    '''
+    ds=open_cumsum(params['r'])
+    shape=(ds.sizes['y'], ds.sizes['x'])
+
+    def build():
+        first, last=window_index(ds.time.values, *params['window'])
+        with metrics.stage('window composite') as info:
+            arr=window_composite(ds, params['names'], params['coeff'], first, last)
+            info['bytes']=arr.nbytes
+        return arr
+
+    return cached_composite(composite_key(params, shape), shape, build)
+
+def daily_aggregate(params, day):
+    '''
+    Masked composite of a day of a scenario, cached like aggregate
+    '''
+    ds=open_daily(params['r'])
+    shape=(ds.sizes['y'], ds.sizes['x'])
+
+    def build():
+        with metrics.stage('daily composite') as info:
+            arr=daily_composite(ds, params['names'], params['coeff'], day)
+            info['bytes']=arr.nbytes
+        return arr
+
+    return cached_composite('{}-day{}'.format(composite_key(params, shape), day), shape, build)
+
+def frame_bytes(scenario, day, fmt=image_format):
+    '''
+    Encoded frame of a day of a registered scenario, None for an
+    unknown scenario or day
+    '''
+    def render():
+        params=scenario_params(scenario)
+        if params is None:
+            return None
+        ds=open_daily(params['r'])
+        if ds is None or not 0<=day<ds.sizes['time']:
+            return None
+        return shade(daily_aggregate(params, day), params['span'], palette(params['cmap']))
+
+    return cached_image('{}-day{}.{}'.format(scenario, day, fmt), fmt, render)
+
+# the frames after the one requested are rendered in the background
+frame_prefetcher=Prefetcher(frame_bytes)
+
+@server.route('/frames/<scenario>/<int:day>.<fmt>')
+@metrics.request('frame')
+def frame(scenario, day, fmt):
+    '''
+    Map of one day of a scenario registered by redraw
+    '''
+    if fmt not in IMAGE_FORMATS:
+        flask.abort(404)
+    etag='{}-day{}.{}'.format(scenario, day, fmt)
+    response=not_modified(etag)
+    if response is not None:
+        return response
+    data=frame_bytes(scenario, day, fmt)
+    if data is None:
+        flask.abort(404)
+    for ahead in range(1, frames_ahead+1):
+        frame_prefetcher.submit(scenario, day+ahead, fmt)
+    return image_response(data, fmt, etag)
+
+def point_query(params, lon, lat):
+    '''
+    Density of a scenario at a point and the contribution of each of
+    its farms, largest first. Only the pixel column of the farm layers
+    under the point is read. None outside the grid.
+    '''
+    names=list(params['names'])
+    if params.get('window'):
+        ds=open_cumsum(params['r'])
+        grid=TileGrid(window_grid()[::-1], (ds.sizes['y'], ds.sizes['x']))
+        pixel=grid.pixel(lon, lat)
+        if pixel is None:
+            return None
+        first, last=window_index(ds.time.values, *params['window'])
+        values=window_column(ds, names, first, last, *pixel)
+    else:
+        compositor, coordinates=get_compositor(params['r'])
+        layers=compositor.layers
+        pixel=TileGrid(coordinates[::-1], layers.shape).pixel(lon, lat)
+        if pixel is None:
+            return None
+        values=np.zeros(len(names), dtype='float32')
+        rows=[i for i, name in enumerate(names) if name in layers.index]
+        values[rows]=layers.column(*pixel)[layers.rows([names[i] for i in rows])]
+    contributions=values*np.asarray(params['coeff'], dtype='float32')
+    density=float(contributions.sum())
+    farms=[{'name': str(names[i]), 'contribution': float(contributions[i]),
+            'share': float(contributions[i]/density)}
+           for i in np.argsort(-contributions) if contributions[i]>0]
+    return {'lon': lon, 'lat': lat, 'density': density, 'farms': farms}
 
+@server.route('/query/<scenario>')
+@metrics.request('query')
+def query(scenario):
+    '''
+    JSON point query of a scenario registered by redraw: ?lon=&lat=
+    '''
+    params=scenario_params(scenario)
+    try:
+        lon, lat=float(flask.request.args['lon']), float(flask.request.args['lat'])
+    except (KeyError, ValueError):
+        flask.abort(400)
+    if not (np.isfinite(lon) and np.isfinite(lat)):
+        flask.abort(400)
+    if params is None:
+        flask.abort(404)
+    return flask.jsonify(point_query(params, lon, lat))
+
+def store_img(key, data, fmt=image_format):
+    '''
+    Url of the encoded heatmap of the scenario key under the hash of its
+    content. The bytes stay in render_cache, the url only maps to key.
+    '''
+    digest=content_hash(data)
+    render_cache.set('image/{}.{}'.format(digest, fmt), key.encode())
+    return '{}heatmaps/{}.{}'.format(flask.request.host_url, digest, fmt)
+
+@server.route('/heatmaps/<digest>.<fmt>')
+@metrics.request('heatmap')
+def heatmap_image(digest, fmt):
+    '''
+    Serve a heatmap stored by store_img, rendered again if it was
+    evicted. Only in the format it was stored in.
+    '''
+    if fmt!=image_format:
+        flask.abort(404)
+    response=not_modified(digest)
+    if response is not None:
+        return response
+    key=render_cache.get('image/{}.{}'.format(digest, fmt))
+    if key is None:
+        flask.abort(404)
+    key=key.decode()
+    params=scenario_params(key)
+    if params is None:
+        flask.abort(404)
+    return image_response(heatmap_bytes(params, key), fmt, digest)
 
 app.title="Heatmap Dashboard"
-app.layout = dbc.Container([
+
+layouts={}
+layout_lock=threading.Lock()
+def mk_layout():
+    '''
+    Built on the first page load rather than at import, and again when
+    the time stores have new days
+    '''
+    days=daily_times(), window_times()
+    key=tuple(map(tuple, days))
+    with layout_lock:
+        if key not in layouts:
+            layouts.clear()
+            layouts[key]=build_layout(*days)
+        return layouts[key]
+
+@profile.phase('layout build')
+def build_layout(days, windows):
+    farms=farm_data()
+    return dbc.Container([
     #Store
     html.Div([
-        dcc.Store(id='my-store'),
+        dcc.Store(id='my-store', storage_type='session'),
+        dcc.Store(id='themes', data=theme_data()),
+        # map layers of the last scenario in each theme
+        dcc.Store(id='raster-sources', data={}),
+        # url prefix of its daily frames in each theme
+        dcc.Store(id='frame-sources', data={}),
+        # key of the scenario on the map, for the point queries
+        dcc.Store(id='scenario-key'),
     #header
         html.Div([
             html.H1('Visualisation of the Clyde sealice infestation'),
@@ -520,37 +1176,138 @@ app.layout = dbc.Container([
     # Define tabs
         html.Div([
             dbc.Tabs([
-                dbc.Tab(tab1_layout(farm_loc,computed_farms,center_lat, center_lon, span, cmp1, template_theme1),label='Interactive map',tab_id='tab-main',),
-                dbc.Tab(tab2_layout(All_names[computed_farms],farm_loc),label='Tuning dashboard',tab_id='tab-tunning',),
+                dbc.Tab(tab1_layout(farms,center_lat, center_lon, span, palette(cmp1), template_theme1, days, windows),label='Interactive map',tab_id='tab-main',),
+                dbc.Tab(tab2_layout(farms),label='Tuning dashboard',tab_id='tab-tunning',),
                 dbc.Tab(tab3_layout(start, end),label='Live progress graph',tab_id='tab-graph',),
                 ])
             ])
         ])
 ], fluid=True, className='dbc')
 
+def serve_layout():
+    '''
+    Dash also asks for the layout on the first request of a worker
+    (often the warmup) to validate it, it gets a placeholder.
+    Only the pages loading the layout pay for building it.
+    '''
+    if flask.has_request_context() and not flask.request.path.endswith('_dash-layout'):
+        return html.Div()
+    return mk_layout()
+
+# the ids only exist once the layout is built, Dash would otherwise
+# call serve_layout right away to validate the callbacks against it
+app.config.suppress_callback_exceptions = True
+app.layout = serve_layout
+
+
+@once
+def pyramid_levels():
+    '''
+    [{'path', 'resolution'}] of the levels of the pyramid, finest first,
+    none without a pyramid
+    '''
+    from pyramid import levels
+    if not gcs_fs().exists(pyramid_name):
+        return []
+    return levels(cached_map(pyramid_name, persist=False))
+
+def resolutions():
+    '''
+    Resolutions (m) of the layers of the registry: those of the
+    dashboard, then the coarser levels of the pyramid for the zoomed
+    out tiles
+    '''
+    coarser=[d['resolution'] for d in pyramid_levels() if d['resolution']>resolution_M[-1]]
+    return resolution_M+coarser
+
+def master_name(r):
+    '''
+    Store holding the layers of resolution r, the pyramid if there is one
+    '''
+    fs = gcs_fs()
+    if fs.exists(pyramid_name):
+        return pyramid_name
+    return 'sealice_db/aggregations_{}m/master.zarr'.format(resolution_M[r])
 
-@cache.memoize()
-def global_store(r):
+def open_master(r):
+    from xarray import open_zarr
+    from pyramid import levels, pick_level
     print('using global store')
-    fs = gcsfs.GCSFileSystem()
-    gcs_bucket_name ='sealice_db/aggregations_{}m/master.zarr'.format(resolution_M[r])
-    gcsmap = gcsfs.mapping.GCSMap(gcs_bucket_name, gcs=fs, check=True, create=False)
-    super_ds=open_zarr(gcsmap).drop('spatial_ref')
-    All_names=list(super_ds.keys())
-    coordinates=np.load(coord_file)
-    #get_coordinates(super_ds.to_stacked_array('v', ['y', 'x']).sum(dim='v'))
-    print('global store loaded')
-    return super_ds,coordinates
+    gcs_bucket_name = master_name(r)
+    # read once: the registry keeps the layers in /tmp/layers
+    gcsmap = cached_map(gcs_bucket_name, persist=False)
+    if gcs_bucket_name == pyramid_name:
+        # every resolution derived from the 50m layers in one store
+        group = pick_level(levels(gcsmap), resolutions()[r])['path']
+        super_ds = open_zarr(gcsmap, group=group)
+    else:
+        super_ds = open_zarr(gcsmap).drop('spatial_ref')
+    return super_ds
 
+def master_version(r):
+    return store_token(gcs_fs(), master_name(r))
+
+# layers mapped from /tmp, shared by all the workers of the instance
+layer_registry = LayerRegistry('/tmp/layers', open_master, master_version,
+                               check_interval=store_check_interval, dtype=layer_dtype)
+
+def data_version(r):
+    '''
+    Version of the layers of r in the scenario keys: the token of the
+    source store and the storage dtype
+    '''
+    return '{}-{}'.format(layer_registry.version(r), layer_registry.dtype)
+
+@once
+def pyramid_base():
+    '''
+    Cell centres (y, x) of the finest level of the pyramid, the grid
+    master_coordinates is the overlay of
+    '''
+    from xarray import open_zarr
+    from pyramid import levels
+    gcsmap=cached_map(pyramid_name, persist=False)
+    with open_zarr(gcsmap, group=levels(gcsmap)[0]['path']) as ds:
+        return ds['y'].values, ds['x'].values
+
+def grid_coordinates(r, layers):
+    '''
+    Corners of the grid of the layers of r, in the order of
+    master_coordinates. The coarse levels of the pyramid are padded to
+    whole blocks of 50m cells so they cover more ground.
+    '''
+    coordinates=master_coordinates()
+    if master_name(r)!=pyramid_name:
+        return coordinates
+    base_y, base_x=pyramid_base()
+    corners=grid_corners(coordinates[::-1], base_y, base_x, layers.y, layers.x)
+    return np.array(corners[::-1])
+
+compositors={}
+def get_compositor(r):
+    '''
+    One compositor per resolution and per worker, so the output
+    buffers are reused from one render to the next, with the corners
+    of its grid. It is replaced when the registry reopened the layers.
+    '''
+    layers=layer_registry.get(r)
+    if r not in compositors or compositors[r][0].layers is not layers:
+        compositors[r]=Compositor(layers), grid_coordinates(r, layers)
+    return compositors[r]
 
 
 @app.callback(
-    [Output({'type':'biomass_slider', 'id':MATCH}, 'disabled'),
-    Output({'type':'lice_slider', 'id':MATCH}, 'disabled')],
-    Input({'type':'switch', 'id':MATCH},'on'),
+    Output('my-store','data'),
+    Input('my-store','modified_timestamp'),
+    State('my-store','data')
 )
-def desactivate_farms(switch):
-    return not switch, not switch
+def init_session(ts, session):
+    '''
+    Give each browser session an id to keep its last composite
+    '''
+    if session is None:
+        return uuid4().hex
+    raise PreventUpdate
 
 @app.callback(
     Output('egg_toggle_output','children'),
@@ -562,80 +1319,213 @@ def toggle_egg_models(eggs):
     else:
         return 'Rittenhouse et al. (2016)'
 
-@app.callback(
-    [Output({'type':'biomass_slider', 'id':ALL}, 'value'),
-    Output({'type':'lice_slider', 'id':ALL}, 'value')],
+# the farm table and its vectors are updated in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace='sealice', function_name='set_all_farms'),
+    Output('farm-table', 'data'),
     [Input('master_lice_slider', 'value'),
     Input('master_biomass_slider','value')],
-    [State({'type':'biomass_slider', 'id':ALL},'value')]
+    State('farm-table', 'data'),
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='sealice', function_name='farm_coefficients'),
+    Output('farm-coefficients', 'data'),
+    Input('farm-table', 'data'),
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='sealice', function_name='switch_theme'),
+    [Output('heatmap', 'figure', allow_duplicate=True),
+    Output('progress-curves','figure')],
+    Input(ThemeSwitchAIO.ids.switch("theme"), "value"),
+    [State('heatmap', 'figure'),
+    State('progress-curves','figure'),
+    State('themes', 'data'),
+    State('raster-sources', 'data'),
+    State('frame-sources', 'data'),
+    State('day-slider', 'value')],
+    prevent_initial_call=True,
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='sealice', function_name='show_day'),
+    Output('heatmap', 'figure', allow_duplicate=True),
+    Input('day-slider', 'value'),
+    [State(ThemeSwitchAIO.ids.switch("theme"), "value"),
+    State('heatmap', 'figure'),
+    State('raster-sources', 'data'),
+    State('frame-sources', 'data')],
+    prevent_initial_call=True,
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='sealice', function_name='move_window'),
+    Output('progress-curves','figure', allow_duplicate=True),
+    [Input('window-picker', 'start_date'),
+    Input('window-picker', 'end_date')],
+    State('progress-curves','figure'),
+    prevent_initial_call=True,
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='sealice', function_name='toggle_play'),
+    [Output('day-player', 'disabled'),
+    Output('day-play', 'children')],
+    Input('day-play', 'n_clicks'),
+    prevent_initial_call=True,
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='sealice', function_name='next_day'),
+    Output('day-slider', 'value'),
+    Input('day-player', 'n_intervals'),
+    [State('day-slider', 'value'),
+    State('day-slider', 'max')],
+    prevent_initial_call=True,
 )
-def update_all_sliders(lice, biom, l):
-    Nb=len(l)
-    return (np.ones(Nb)*biom).tolist(), (np.ones(Nb)*lice).tolist()
 
 @app.callback(
     [Output('heatmap', 'figure'),
-    Output('progress-curves','figure'),
+    Output('raster-sources', 'data'),
+    Output('frame-sources', 'data'),
+    Output('scenario-key', 'data'),
     Output('heatmap_output', 'children')],
     [Input('submit_map','n_clicks'),
-    Input(ThemeSwitchAIO.ids.switch("theme"), "value"),
+    Input('window-picker', 'start_date'),
+    Input('window-picker', 'end_date'),
     ],
     [
+    State(ThemeSwitchAIO.ids.switch("theme"), "value"),
     State('egg_toggle','on'),
-    State({'type':'switch', 'id':ALL},'on'),
-    State({'type':'biomass_slider', 'id':ALL},'value'),
-    State({'type':'lice_slider', 'id':ALL},'value'),
+    State('farm-coefficients', 'data'),
     State('span-slider','value') ,
     State('resolution-slider','value'),
-    State('heatmap', 'figure'),
-    State('progress-curves','figure'),
+    State('my-store','data'),
+    State('day-slider', 'value'),
     ]
 )
-def redraw(n_clicks, toggle, egg, idx, biomasses, lices, span, r, fig, curves):
-    ctx = dash.callback_context
-    ### toggle themes
-    template = template_theme1 if toggle else template_theme2
-    cmp= cmp1 if toggle else cmp2
-    carto_style= carto_style1 if toggle else carto_style2
-    fig['layout']['template']=mk_template(template)
-    curves['layout']['template']=mk_template(template)
-    fig['layout']['mapbox']['style']=carto_style
-    #fig.update_traces(marker=dict(colorscale=cmp))
-    fig['data'][0]['marker']['colorscale']=mk_colorscale(cmp)
-    #print(fig['data'][0]['marker']['colorscale'])
-
+@metrics.request('redraw')
+def redraw(n_clicks, window_start, window_end, toggle, egg, coefficients, span, r, session, day):
+    # the theme itself is applied in the browser (assets/themes.js),
+    # the figure is patched so that it does not go through the server
+    fig=Patch()
+    rasters, frames, scenario={}, {}, None
     ### update heatmap
-    if ctx.triggered[0]['prop_id'] == 'submit_map.n_clicks':
-        idx=np.array(idx)
-        biomasses=np.array(biomasses)
-        lices=np.array(lices, dtype='float')*2
+    if n_clicks:
+        idx=np.array(coefficients['on'], dtype=bool)
+        biomasses=np.array(coefficients['biomass'], dtype='float')
+        lices=np.array(coefficients['lice'], dtype='float')*2
         # modify egg model from Rittenhouse (16.9) to Stein (30)
         if egg:
             lices *= 30/16.9
         if idx.sum()>0:
-            name_list=np.array(All_names)[computed_farms][idx]
+            farms=farm_data()
+            rows=farms.processed[idx]
+            name_list=farms.name[rows]
             Coeff=biomasses[idx]*lices[idx]
-            super_ds, coordinates=global_store(r)
 
-            selected_farms=(farm_loc[:,0][:,None]==name_list).any(axis=1)
             fig['data'][0]['marker']['cmax']=span[1]
             fig['data'][0]['marker']['cmin']=span[0]
-            fig['data'][3]=go.Scattermapbox(lat=farm_loc[selected_farms][:,-2],
-                                lon=farm_loc[selected_farms][:,-1],
+            fig['data'][3]=go.Scattermapbox(lat=farms.lat[rows],
+                                lon=farms.lon[rows],
                                 marker=dict(color='#e9ecef', size=4, showscale=False),
                                 name='Mapped farms')
-            fig['layout']['mapbox']['layers']=[
-                                    {
-                                        "below": 'traces',
-                                        "sourcetype": "image",
-                                        "source": mk_img(super_ds, name_list, span, Coeff,cmp),
-                                        "coordinates": coordinates[::-1]
-                                    }]
+            # master.zarr holds the average of the default interval
+            window=(window_start, window_end)
+            if open_cumsum(r) is None or window==(start, end) or None in window:
+                window=None
+            daily=open_daily(r) is not None
+            show_day=daily and day is not None and day>=0
+            theme='dark' if toggle else 'light'
+            # the scenario of the other theme is only rendered if toggled,
+            # the average is not rendered while a day is displayed
+            for name, (_, _, _, cmp_name) in themes.items():
+                params, key=canonical_scenario(r, name_list, Coeff, span, egg, cmp_name,
+                                               window, data_version(r))
+                register_scenario(key, params)
+                if name==theme:
+                    scenario=key
+                rasters[name]=[raster_layer(params, key, session,
+                                            eager=name==theme and not show_day)]
+                if daily:
+                    # the browser puts the day in the source
+                    frames[name]=[frame_layer(key, '{day}')]
+                    if name==theme and show_day:
+                        fig['layout']['mapbox']['layers']=[frame_layer(key, day)]
+            if not show_day:
+                fig['layout']['mapbox']['layers']=rasters[theme]
         else:
             # add a message?
             fig['data'][3]={}
             fig['layout']['mapbox']['layers']=[]
-    return fig, curves, None
+    return fig, rasters, frames, scenario, None
+
+@app.callback(
+    Output('heatmap', 'figure', allow_duplicate=True),
+    Input('query-mode', 'on'),
+    prevent_initial_call=True,
+)
+def toggle_query_grid(on):
+    '''
+    Clickable grid over the overlay while the query mode is on
+    '''
+    fig=Patch()
+    if on:
+        fig['data'].append(mk_query_grid(master_coordinates()[::-1], query_grid))
+    else:
+        del fig['data'][4]
+    return fig
+
+@app.callback(
+    Output('point-query', 'children'),
+    Input('heatmap', 'clickData'),
+    State('scenario-key', 'data'),
+    prevent_initial_call=True,
+)
+@metrics.request('point query')
+def show_point_query(click, scenario):
+    params=scenario_params(scenario) if scenario else None
+    if not click or params is None:
+        raise PreventUpdate
+    point=click['points'][0]
+    return mk_point_query(point_query(params, point['lon'], point['lat']))
+
+def warm_default_scenario():
+    '''
+    Render the map of the dashboard defaults: every processed farm,
+    biomass 100%, 0.5 lice/fish, Rittenhouse eggs, the dark theme,
+    with the tiles around the initial zoom
+    '''
+    farms=farm_data()
+    names=farms.name[farms.processed]
+    params, key=canonical_scenario(1, names, np.ones(len(names)), span, False, cmp1,
+                                   version=data_version(1))
+    register_scenario(key, params)
+    if not use_tiles:
+        heatmap_bytes(params, key)
+        return
+    for z in (6, 7, 8):
+        for x, y in tiles_covering(master_coordinates()[::-1], z):
+            tile_bytes(key, z, x, y, image_format)
+
+def startup_report():
+    '''
+    Print the startup profile. The imports are no longer timed: the
+    ones run lazily by the requests are not part of the startup.
+    '''
+    profile.stop_imports()
+    if profile.enabled:
+        print(profile.report())
+
+warmup_routine = Warmup([
+    ('farm registry', farm_data),
+    ('coordinates', master_coordinates),
+    ('default layers', lambda: get_compositor(1)),
+    ('layout', mk_layout),
+    ('default scenario', warm_default_scenario),
+    ('startup report', startup_report),
+])
 
 if __name__ == '__main__':
     app.run_server(host='0.0.0.0', port=8080, debug=True)
@@ -0,0 +1,150 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import bisect
+import contextlib
+import os
+import resource
+import threading
+import time
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.bytes = 0
+
+    def observe(self, seconds, nbytes=0):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.bytes += nbytes
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+class Metrics:
+    '''
+    Duration and bytes of each render stage and request of this worker.
+    The stages of a request are also kept in a thread local record so
+    the requests slower than slow_request seconds (0: never) are logged
+    with their breakdown.
+    '''
+    def __init__(self, prefix='sealice', slow_request=0):
+        self.prefix = prefix
+        self.slow_request = slow_request
+        self.stages = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def observe(self, table, name, seconds, nbytes=0):
+        with self._lock:
+            if name not in table:
+                table[name] = Histogram()
+            table[name].observe(seconds, nbytes)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Time a stage, the bytes it produced can be set in the yielded dict
+        '''
+        info = {'bytes': 0}
+        t0 = time.perf_counter()
+        try:
+            yield info
+        finally:
+            dt = time.perf_counter() - t0
+            self.observe(self.stages, name, dt, info['bytes'])
+            record = getattr(self._local, 'record', None)
+            if record is not None:
+                record.append((name, dt, info['bytes']))
+
+    @contextlib.contextmanager
+    def request(self, name):
+        '''
+        Time a whole request and collect the stages run inside it
+        '''
+        self._local.record = record = []
+        info = {'bytes': 0}
+        t0 = time.perf_counter()
+        try:
+            yield info
+        finally:
+            dt = time.perf_counter() - t0
+            self._local.record = None
+            self._local.elapsed = getattr(self._local, 'elapsed', 0) + dt
+            self.observe(self.requests, name, dt, info['bytes'])
+            if self.slow_request and dt > self.slow_request:
+                print('slow request {} {:.3f}s: {}'.format(name, dt, ', '.join(
+                    '{} {:.3f}s {}B'.format(*stage) for stage in record)))
+
+    def pop_elapsed(self):
+        '''
+        Time spent in requests timed by this thread since the last call
+        '''
+        elapsed = getattr(self._local, 'elapsed', 0)
+        self._local.elapsed = 0
+        return elapsed
+
+    def render(self, extra=()):
+        '''
+        Prometheus text format, extra are other metrics as
+        (name, help, type, {labels: value})
+        '''
+        lines = []
+        with self._lock:
+            for metric, label, table in (('stage', 'stage', self.stages),
+                                         ('request', 'route', self.requests)):
+                full = '{}_{}_seconds'.format(self.prefix, metric)
+                lines += ['# HELP {} Duration of each {}'.format(full, metric),
+                          '# TYPE {} histogram'.format(full)]
+                for name, hist in sorted(table.items()):
+                    cumulative = 0
+                    for le, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                        cumulative += count
+                        lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(
+                            full, label, name, le, cumulative))
+                    lines.append('{}_sum{{{}="{}"}} {}'.format(full, label, name, hist.sum))
+                    lines.append('{}_count{{{}="{}"}} {}'.format(full, label, name, hist.count))
+                full = '{}_{}_bytes_total'.format(self.prefix, metric)
+                lines += ['# HELP {} Bytes produced by each {}'.format(full, metric),
+                          '# TYPE {} counter'.format(full)]
+                lines += ['{}{{{}="{}"}} {}'.format(full, label, name, hist.bytes)
+                          for name, hist in sorted(table.items())]
+        for name, doc, kind, values in list(extra) + memory_gauges():
+            lines += ['# HELP {} {}'.format(name, doc), '# TYPE {} {}'.format(name, kind)]
+            for labels, value in values.items():
+                lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', value))
+        return '\n'.join(lines) + '\n'
+
+
+def memory_gauges():
+    '''
+    Resident and peak resident memory of the process
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        rss = peak
+    return [('process_resident_memory_bytes', 'Resident memory size', 'gauge', {'': rss}),
+            ('process_peak_resident_memory_bytes', 'Peak resident memory size', 'gauge',
+             {'': peak})]
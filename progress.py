@@ -0,0 +1,69 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import queue
+import threading
+import time
+
+
+def load_all(paths, reduce, max_workers=8, timeout=120, deadline=120):
+    '''
+    Run reduce(path) on every path, at most max_workers at a time.
+    A store taking more than timeout seconds once started is given up
+    and frees its worker for the next one. The stores not done after
+    deadline seconds overall are given up, started or not; None waits
+    for all of them.
+    Returns the [(path, result)] of the successful ones in the order of
+    paths and the {path: error} of the others.
+    '''
+    done = queue.Queue()
+
+    def run(path):
+        try:
+            done.put((path, True, reduce(path)))
+        except Exception as exc:
+            done.put((path, False, repr(exc)))
+
+    results, errors = {}, {}
+    waiting = list(reversed(paths))
+    running = {}
+    end = None if deadline is None else time.monotonic() + deadline
+    while waiting or running:
+        while waiting and len(running) < max_workers:
+            path = waiting.pop()
+            running[path] = time.monotonic()
+            # daemon threads: a store that hangs is left behind, even at exit
+            threading.Thread(target=run, args=(path,), daemon=True).start()
+        try:
+            path, ok, value = done.get(timeout=0.5)
+        except queue.Empty:
+            pass
+        else:
+            if running.pop(path, None) is not None:
+                if ok:
+                    results[path] = value
+                else:
+                    errors[path] = value
+        now = time.monotonic()
+        for path, started in list(running.items()):
+            if now - started > timeout:
+                errors[path] = 'timed out after {}s'.format(timeout)
+                del running[path]
+        if end is not None and now > end:
+            for path in running:
+                errors[path] = 'not done after {}s'.format(deadline)
+            for path in waiting:
+                errors[path] = 'not started after {}s'.format(deadline)
+            break
+    return [(path, results[path]) for path in paths if path in results], errors
@@ -0,0 +1,86 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import sys
+import zarr
+from xarray import open_zarr
+
+
+def downsample(ds, factor):
+    '''
+    Area weighted average of factor x factor blocks.
+    NaNs count as no density, the incomplete blocks of the edges
+    are averaged over the cells they cover.
+    '''
+    if factor == 1:
+        return ds
+    return ds.fillna(0).coarsen(y=factor, x=factor, boundary='pad').mean()
+
+
+def build_pyramid(ds, store, base_res=50, factors=(1, 2, 4, 8, 16)):
+    '''
+    Write the levels base_res*factors of the farm layers of ds
+    as the groups '0', '1'... of one multiscale zarr store.
+    Every level is derived from the base resolution.
+    '''
+    ds = ds.drop_vars('spatial_ref', errors='ignore')
+    datasets = []
+    for level, factor in enumerate(factors):
+        res = base_res * factor
+        print('writing level {} ({}m)'.format(level, res))
+        sub = downsample(ds, factor)
+        sub.attrs['resolution'] = res
+        sub.to_zarr(store, group=str(level), mode='w')
+        datasets.append({'path': str(level), 'resolution': res})
+    root = zarr.open_group(store, mode='a')
+    root.attrs['multiscales'] = [{'name': 'farm_layers', 'datasets': datasets}]
+    zarr.consolidate_metadata(store)
+    return datasets
+
+
+def levels(store):
+    '''
+    The [{'path', 'resolution'}] of a pyramid, finest first
+    '''
+    root = zarr.open_group(store, mode='r')
+    datasets = root.attrs['multiscales'][0]['datasets']
+    return sorted(datasets, key=lambda d: d['resolution'])
+
+
+def pick_level(datasets, pixel_size):
+    '''
+    Coarsest level still at least as fine as the output pixel size (m)
+    '''
+    best = datasets[0]
+    for d in datasets:
+        if d['resolution'] <= pixel_size:
+            best = d
+    return best
+
+
+def open_level(store, pixel_size):
+    '''
+    Open the level of the pyramid to use for a pixel size in metres
+    '''
+    level = pick_level(levels(store), pixel_size)
+    return open_zarr(store, group=level['path'])
+
+
+if __name__ == '__main__':
+    # python pyramid.py <50m master.zarr> <pyramid.zarr>
+    import gcsfs
+    fs = gcsfs.GCSFileSystem()
+    src = gcsfs.mapping.GCSMap(sys.argv[1], gcs=fs, check=True, create=False)
+    dst = gcsfs.mapping.GCSMap(sys.argv[2], gcs=fs, check=False, create=True)
+    build_pyramid(open_zarr(src), dst)
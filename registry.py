@@ -0,0 +1,129 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import fcntl
+import os
+import threading
+import time
+
+import layers
+from layers import coords_path
+
+
+def store_token(fs, path):
+    '''
+    Version of a zarr store from the metadata of its root object
+    (generation on GCS, mtime on a local directory...)
+    '''
+    for name in ('.zmetadata', '.zgroup'):
+        try:
+            info = fs.info(path.rstrip('/') + '/' + name)
+        except (FileNotFoundError, OSError):
+            continue
+        for field in ('generation', 'mtime', 'updated', 'etag', 'ETag', 'md5Hash'):
+            if info.get(field) is not None:
+                return str(info[field])
+        return str(info.get('size'))
+    return None
+
+
+class LayerRegistry:
+    '''
+    Farm layers of each resolution loaded once per instance.
+    The first worker needing a resolution writes its layers, sparse or
+    dense (see layers.from_dataset), to a .npy file in directory, every
+    worker then memory-maps it read only so they all share the same
+    pages instead of unpickling a copy.
+    The source is checked with token(r) at most every check_interval
+    seconds and the file rebuilt with opener(r) when it changed.
+    dtype is the storage of the values, see layers.encode.
+    '''
+    def __init__(self, directory, opener, token, check_interval=300, dtype='float32'):
+        self.directory = directory
+        self.dtype = dtype
+        self.opener = opener
+        self.token = token
+        self.check_interval = check_interval
+        self._open = {}
+        # one lock per resolution: building one does not hold up the others
+        self._locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, r):
+        return os.path.join(self.directory, 'layers_{}_{}.npy'.format(r, self.dtype))
+
+    def _read_version(self, r):
+        try:
+            with open(self._path(r) + '.version') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _build(self, r, version):
+        print('building shared layers {}'.format(r))
+        path = self._path(r)
+        tmp = os.path.join(self.directory, 'layers_{}_{}.tmp.npy'.format(r, self.dtype))
+        layers.from_dataset(self.opener(r), mmap_path=tmp, dtype=self.dtype)
+        os.replace(coords_path(tmp), coords_path(path))
+        os.replace(tmp, path)
+        with open(path + '.version.tmp', 'w') as f:
+            f.write(version)
+        os.replace(path + '.version.tmp', path + '.version')
+
+    def _load(self, r, version):
+        '''
+        Map the layers of r at version, building them under a file lock
+        so only one worker of the instance does it
+        '''
+        with open(self._path(r) + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self._read_version(r) != version or not os.path.isfile(self._path(r)):
+                    self._build(r, version)
+                return layers.load(self._path(r))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _resolution_lock(self, r):
+        with self._lock:
+            return self._locks.setdefault(r, threading.Lock())
+
+    def get(self, r):
+        with self._resolution_lock(r):
+            entry = self._open.get(r)
+            now = time.monotonic()
+            if entry is not None and now - entry[2] < self.check_interval:
+                return entry[0]
+            try:
+                version = str(self.token(r))
+            except OSError as exc:
+                if entry is None:
+                    raise
+                print(exc)
+                version = entry[1]
+            if entry is None or entry[1] != version:
+                entry = self._load(r, version), version, now
+            else:
+                entry = entry[0], version, now
+            self._open[r] = entry
+            return entry[0]
+
+    def version(self, r):
+        '''
+        Source version of the layers get(r) returns
+        '''
+        self.get(r)
+        with self._resolution_lock(r):
+            return self._open[r][1]
@@ -0,0 +1,178 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+import numpy as np
+
+COEFF_QUANTUM = 0.001
+
+
+def canonical_scenario(r, names, coeff, span, egg, cmap, window=None, version=None,
+                       quantum=COEFF_QUANTUM):
+    '''
+    Scenario parameters in a canonical form and their hash.
+    Farms are sorted by name, coefficients rounded to quantum and the
+    farms with a null coefficient dropped, so that equivalent settings
+    of the dashboard give the same key.
+    window is the (start, end) dates of the average, None for master.zarr.
+    version identifies the layers rendered (source store and storage),
+    a new version gives new keys so no cache serves the old maps.
+    '''
+    farms = {}
+    for name, c in zip(names, coeff):
+        q = round(round(float(c) / quantum) * quantum, 6)
+        if q != 0:
+            farms[str(name)] = q
+    names = sorted(farms)
+    params = {'r': int(r),
+              'names': names,
+              'coeff': [farms[name] for name in names],
+              'span': [float(s) for s in span],
+              'egg': bool(egg),
+              'cmap': cmap}
+    if window is not None:
+        params['window'] = [str(np.datetime64(day, 'D')) for day in window]
+    if version is not None:
+        params['version'] = str(version)
+    blob = json.dumps(params, sort_keys=True).encode()
+    return params, hashlib.sha1(blob).hexdigest()[:16]
+
+
+def composite_key(params, shape):
+    '''
+    Hash of what the aggregated composite of a scenario depends on:
+    the span, the palette and the theme only change its shading.
+    The egg model is already folded in the coefficients.
+    '''
+    depends = {'r': params['r'], 'names': params['names'],
+               'coeff': params['coeff'], 'shape': list(shape),
+               'version': params.get('version')}
+    if params.get('window'):
+        depends['window'] = params['window']
+    blob = json.dumps(depends, sort_keys=True).encode()
+    return hashlib.sha1(blob).hexdigest()[:16]
+
+
+class RenderCache:
+    '''
+    Rendered bytes in two tiers: a bounded LRU in the process and a size
+    capped directory shared by the gunicorn workers of the instance.
+    The disk entries are evicted oldest access first.
+    max_memory=0 disables the memory tier.
+    '''
+    def __init__(self, directory, max_memory=64 * 2**20, max_disk=512 * 2**20):
+        self.directory = directory
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, quote(key, safe=''))
+
+    def _remember(self, key, data):
+        if self.max_memory <= 0:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_size -= len(self._memory.pop(key))
+            self._memory[key] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.max_memory and len(self._memory) > 1:
+                _, old = self._memory.popitem(last=False)
+                self._memory_size -= len(old)
+
+    def __contains__(self, key):
+        return key in self._memory or os.path.isfile(self._path(key))
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return data
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits_disk += 1
+        self._remember(key, data)
+        return data
+
+    def set(self, key, data):
+        self._remember(key, data)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            # a full /tmp must not keep the partial file
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+        self._writes += 1
+        if self._writes % 32 == 0:
+            self.prune()
+
+    def prune(self):
+        '''
+        Remove the least recently used files above max_disk
+        '''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            return {'hits_memory': self.hits_memory,
+                    'hits_disk': self.hits_disk,
+                    'misses': self.misses,
+                    'memory_items': len(self._memory),
+                    'memory_bytes': self._memory_size}
@@ -0,0 +1,90 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import threading
+import numpy as np
+from PIL import Image
+
+LUT_LEVELS = 4096
+
+_luts = {}
+_lock = threading.Lock()
+
+
+def hex_rgb(colour):
+    colour = colour.lstrip('#')
+    return [int(colour[i:i + 2], 16) for i in (0, 2, 4)]
+
+
+def palette_lut(cmap, levels=LUT_LEVELS):
+    '''
+    RGBA colours of levels values evenly spread over the span, as one
+    uint32 per colour, then a transparent entry for the masked pixels.
+    The colours are interpolated between the palette stops and
+    truncated to uint8 like datashader does for a linear span.
+    '''
+    key = (tuple(cmap), levels)
+    lut = _luts.get(key)
+    if lut is None:
+        stops = np.linspace(0, 1, len(cmap))
+        channels = np.array([hex_rgb(c) for c in cmap]).T
+        x = np.linspace(0, 1, levels)
+        rgba = np.zeros((levels + 1, 4), dtype='uint8')
+        for i, channel in enumerate(channels):
+            rgba[:levels, i] = np.interp(x, stops, channel).astype('uint8')
+        rgba[:levels, 3] = 255
+        lut = rgba.view('uint32').ravel()
+        with _lock:
+            _luts[key] = lut
+    return lut
+
+
+def shade(arr, span, cmap, origin='lower'):
+    '''
+    PIL RGBA image of a float array: values clipped to span and linearly
+    mapped on the palette cmap (a list of hex colours), transparent
+    where the value is <= 0 or NaN.
+    origin='lower' puts the row 0 of arr at the bottom of the image.
+    '''
+    lut = palette_lut(cmap)
+    levels = len(lut) - 1
+    if origin == 'lower':
+        arr = arr[::-1]
+    s0, s1 = float(span[0]), float(span[1])
+    scale = (levels - 1) / (s1 - s0) if s1 > s0 else 0.
+    idx = np.subtract(arr, s0, dtype='float32')
+    idx *= scale
+    np.clip(idx, 0, levels - 1, out=idx)
+    idx += 0.5
+    with np.errstate(invalid='ignore'):
+        np.copyto(idx, levels, where=~(arr > 0))
+    rgba = lut.take(idx.astype('uint16'))
+    return Image.fromarray(rgba.view('uint8').reshape(arr.shape + (4,)), 'RGBA')
+
+
+def compare_datashader(arr, span, cmap, origin='lower'):
+    '''
+    Largest difference of a colour channel between shade and datashader
+    on the same array, alpha included
+    '''
+    from xarray import DataArray
+    from datashader import transfer_functions as tf
+    masked = np.where(arr > 0, arr, np.nan)
+    reference = tf.shade(DataArray(masked, dims=('y', 'x')), cmap=cmap, how='linear',
+                         span=span).to_pil(origin=origin)
+    ours = shade(arr, span, cmap, origin)
+    diff = np.abs(np.asarray(reference, dtype='int16') - np.asarray(ours, dtype='int16'))
+    # the colour of transparent pixels does not show
+    diff[np.asarray(reference)[..., 3] == 0] = 0
+    return int(diff.max())
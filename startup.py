@@ -0,0 +1,130 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import builtins
+import contextlib
+import functools
+import sys
+import threading
+import time
+
+
+def once(func):
+    '''
+    Deferred data handle: func runs on the first call only,
+    the threads calling it meanwhile wait for that result
+    '''
+    lock = threading.Lock()
+    result = []
+
+    @functools.wraps(func)
+    def wrapper():
+        if not result:
+            with lock:
+                if not result:
+                    result.append(func())
+        return result[0]
+
+    wrapper.loaded = lambda: bool(result)
+    return wrapper
+
+
+class Warmup:
+    '''
+    Run the warmup steps [(name, func)] once, in a background thread,
+    and keep the state and duration of each step
+    '''
+    def __init__(self, steps):
+        self.steps = steps
+        self.status = {name: 'pending' for name, _ in steps}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+        return self.status
+
+    def run(self):
+        for name, func in self.steps:
+            self.status[name] = 'running'
+            t0 = time.perf_counter()
+            try:
+                func()
+            except Exception as exc:
+                self.status[name] = 'failed: {!r}'.format(exc)
+                print('warmup {} failed: {!r}'.format(name, exc))
+            else:
+                self.status[name] = 'done in {:.2f}s'.format(time.perf_counter() - t0)
+
+
+class StartupProfile:
+    '''
+    Duration of the startup phases and, when enabled, the cost of each
+    module imported for the first time (nested imports included)
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+        self.imports = {}
+        self._last = time.perf_counter()
+        self._import = None
+
+    def track_imports(self):
+        if not self.enabled or self._import is not None:
+            return
+        original = self._import = builtins.__import__
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level or name in sys.modules:
+                return original(name, globals, locals, fromlist, level)
+            t0 = time.perf_counter()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                self.imports.setdefault(name, time.perf_counter() - t0)
+
+        builtins.__import__ = timed_import
+
+    def stop_imports(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def mark(self, name):
+        '''
+        Record a phase lasting since the previous mark
+        '''
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - t0))
+
+    def report(self, top=30):
+        lines = ['startup phases:']
+        lines += ['  {:<24} {:8.3f}s'.format(name, dt) for name, dt in self.phases]
+        if self.imports:
+            lines.append('slowest imports (cumulative):')
+            ranked = sorted(self.imports.items(), key=lambda item: -item[1])
+            lines += ['  {:<40} {:8.3f}s'.format(name, dt) for name, dt in ranked[:top]]
+        return '\n'.join(lines)
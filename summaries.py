@@ -0,0 +1,85 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import sys
+import zarr
+from xarray import open_zarr
+
+from progress import load_all
+
+
+def update_farm(root, name, trajectories, overlap=1):
+    '''
+    Append to the summary of a farm the total copepodids of the time
+    steps of its trajectory store not processed yet.
+    The last overlap steps already processed are reduced again in case
+    they were still being written during the previous update.
+    Returns the number of time steps reduced.
+    '''
+    group = root.require_group(name)
+    processed = group.attrs.get('processed', 0)
+    with open_zarr(trajectories) as ds:
+        n = ds.sizes['time']
+        first = max(processed - overlap, 0)
+        if n <= processed and processed > 0:
+            return 0
+        time = ds.time.values[first:]
+        total = ds.copepodid[first:].sum(axis=1).values
+    if 'time' not in group:
+        group.zeros('time', shape=0, chunks=1024, dtype='M8[ns]')
+        group.zeros('copepodid', shape=0, chunks=1024, dtype='float64')
+    for key, values in (('time', time), ('copepodid', total)):
+        group[key].resize(first)
+        group[key].append(values.astype(group[key].dtype))
+    group.attrs['processed'] = n
+    return n - first
+
+
+def update_summaries(store, trajectories, opener, max_workers=8):
+    '''
+    Bring the summary of every trajectory store up to date.
+    trajectories are the store paths, opener(path) their zarr mapping.
+    The farms are reduced concurrently.
+    '''
+    root = zarr.open_group(store, mode='a')
+
+    def update(path):
+        return update_farm(root, path.rstrip('/').split('/')[-1], opener(path))
+
+    # offline: as long as the stores take
+    done, errors = load_all(trajectories, update, max_workers=max_workers, deadline=None)
+    zarr.consolidate_metadata(store)
+    return done, errors
+
+
+def read_summaries(store):
+    '''
+    [(farm, time, total copepodid)] sorted by farm
+    '''
+    root = zarr.open_consolidated(store, mode='r')
+    return [(name, group['time'][:], group['copepodid'][:])
+            for name, group in sorted(root.groups()) if 'time' in group]
+
+
+if __name__ == '__main__':
+    # python summaries.py <trajectories directory> <summary.zarr>
+    import gcsfs
+    fs = gcsfs.GCSFileSystem()
+    done, errors = update_summaries(fs.get_mapper(sys.argv[2]),
+                                    sorted(fs.ls(sys.argv[1])),
+                                    fs.get_mapper)
+    for path, n in done:
+        print('{}: {} new time steps'.format(path, n))
+    for path, err in errors.items():
+        print('cannot open: {} ({})'.format(path, err))
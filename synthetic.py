@@ -0,0 +1,137 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from windows import update_cumsum
+
+CENTER_LAT, CENTER_LON = 55.7, -5.23
+
+
+def farm_names(n_farms):
+    return ['farm_{:03d}'.format(i) for i in range(n_farms)]
+
+
+def mk_farms(n_farms, extent_km=40, seed=0):
+    '''
+    Random plume parameters: centre (m), width (m) and peak density
+    '''
+    rng = np.random.default_rng(seed)
+    half = extent_km * 500
+    return {'x': rng.uniform(-0.8, 0.8, n_farms) * half,
+            'y': rng.uniform(-0.8, 0.8, n_farms) * half,
+            'sigma': rng.uniform(1000, 3000, n_farms),
+            'peak': rng.uniform(0.5, 5, n_farms)}
+
+
+def mk_master(farms, res=50, extent_km=40, chunks=256):
+    '''
+    master.zarr like Dataset: one (y, x) float32 copepodid density per
+    farm, a gaussian plume cut to 0 far from the farm
+    '''
+    n = int(extent_km * 1000 / res)
+    coords = (np.arange(n) - n / 2 + 0.5) * res
+    names = farm_names(len(farms['x']))
+    data = {}
+    for i, name in enumerate(names):
+        dx = np.exp(-0.5 * ((coords - farms['x'][i]) / farms['sigma'][i])**2)
+        dy = np.exp(-0.5 * ((coords - farms['y'][i]) / farms['sigma'][i])**2)
+        layer = (farms['peak'][i] * dy[:, None] * dx[None, :]).astype('float32')
+        layer[layer < 1e-3 * farms['peak'][i]] = 0
+        data[name] = (('y', 'x'), layer)
+    ds = xr.Dataset(data, coords={'y': coords, 'x': coords})
+    ds['spatial_ref'] = 0
+    return ds.chunk({'y': chunks, 'x': chunks})
+
+
+def mk_daily(master, n_days=30, start='2018-05-06', seed=0):
+    '''
+    daily.zarr like Dataset: the layers of master scaled by a daily
+    infestation curve peaking at a random day of each farm, chunked by day
+    '''
+    rng = np.random.default_rng(seed)
+    days = np.arange(n_days)
+    time = pd.date_range(start, periods=n_days, freq='D').values
+    data = {}
+    for name in master.data_vars:
+        if name == 'spatial_ref':
+            continue
+        peak = rng.uniform(0, n_days)
+        curve = np.exp(-0.5 * ((days - peak) / (n_days / 4))**2)
+        curve = (curve / curve.mean()).astype('float32')
+        data[name] = master[name].expand_dims(time=time) * curve[:, None, None]
+    ds = xr.Dataset(data)
+    return ds.chunk({'time': 1, 'y': master.chunks['y'][0], 'x': master.chunks['x'][0]})
+
+
+def mk_farm_loc(farms, n_pending=0, seed=0):
+    '''
+    modelled_farms.npy like array: name, biomass (tons), lat, lon,
+    in the order of the layers, then n_pending farms that have no layer.
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(farms['x'])
+    names = farm_names(n + n_pending)
+    lat = CENTER_LAT + np.append(farms['y'], rng.uniform(-2e4, 2e4, n_pending)) / 111e3
+    lon = CENTER_LON + np.append(farms['x'], rng.uniform(-2e4, 2e4, n_pending)) / (
+        111e3 * np.cos(np.radians(CENTER_LAT)))
+    biomass = rng.integers(200, 2500, n + n_pending)
+    return np.array([names, biomass, lat, lon]).T
+
+
+def mk_coordinates(extent_km=40):
+    '''
+    master_coordinates.npy like corners (lon, lat), south west first
+    '''
+    dlat = extent_km / 2 / 111
+    dlon = extent_km / 2 / (111 * np.cos(np.radians(CENTER_LAT)))
+    lon0, lon1 = CENTER_LON - dlon, CENTER_LON + dlon
+    lat0, lat1 = CENTER_LAT - dlat, CENTER_LAT + dlat
+    return np.array([[lon0, lat0], [lon1, lat0], [lon1, lat1], [lon0, lat1]])
+
+
+def mk_trajectories(n_time=120, n_particles=2000, seed=0):
+    '''
+    Clyde_trajectories like Dataset: copepodid of each particle in time
+    '''
+    rng = np.random.default_rng(seed)
+    time = pd.date_range('2018-04-01', periods=n_time, freq='D').values
+    copepodid = rng.gamma(2, 0.5, (n_time, n_particles)).astype('float32')
+    return xr.Dataset({'copepodid': (('time', 'particle'), copepodid)},
+                      coords={'time': time}).chunk({'time': 30})
+
+
+def mk_bucket(fs, n_farms=40, resolutions=(50, 100, 200), extent_km=40,
+              n_time=120, n_particles=2000, n_days=0, bucket='sealice_db', seed=0):
+    '''
+    Write a sealice_db like bucket on the fsspec filesystem fs:
+    aggregations_{res}m/master.zarr, aggregations_{res}m/daily.zarr and
+    cumsum.zarr if n_days > 0 and Clyde_trajectories/<farm>.
+    Returns the farm_loc and coordinates arrays.
+    '''
+    farms = mk_farms(n_farms, extent_km, seed)
+    for res in resolutions:
+        root = '{}/aggregations_{}m/'.format(bucket, res)
+        master = mk_master(farms, res, extent_km)
+        master.to_zarr(fs.get_mapper(root + 'master.zarr'), mode='w')
+        if n_days:
+            mk_daily(master, n_days, seed=seed).to_zarr(fs.get_mapper(root + 'daily.zarr'),
+                                                       mode='w')
+            update_cumsum(fs.get_mapper(root + 'daily.zarr'), fs.get_mapper(root + 'cumsum.zarr'))
+    for i, name in enumerate(farm_names(n_farms)):
+        root = '{}/Clyde_trajectories/{}'.format(bucket, name)
+        mk_trajectories(n_time, n_particles, seed + i).to_zarr(fs.get_mapper(root), mode='w')
+    return mk_farm_loc(farms, seed=seed), mk_coordinates(extent_km)
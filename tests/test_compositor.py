@@ -0,0 +1,60 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compositor import Compositor
+from layers import FarmLayers, SparseFarmLayers
+
+
+def plumes(n_farms=30, shape=(120, 100), seed=0):
+    '''
+    Farm layers of gaussian plumes cut to 0 away from the farm
+    '''
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    data = np.zeros((n_farms,) + shape, dtype='float32')
+    for i in range(n_farms):
+        y, x = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+        sigma = rng.uniform(3, 15)
+        plume = rng.uniform(0.1, 50) * np.exp(-((yy - y)**2 + (xx - x)**2) / (2 * sigma**2))
+        plume[plume < 1e-3] = 0
+        data[i] = plume
+    names = ['farm_{:03d}'.format(i) for i in range(n_farms)]
+    return FarmLayers(data, names, np.arange(shape[0]), np.arange(shape[1]))
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_session_render_matches_full_composite(sparse):
+    layers = plumes()
+    if sparse:
+        layers = SparseFarmLayers.from_dense(layers)
+    compositor = Compositor(layers, max_changed=1., max_updates=10**6)
+    rng = np.random.default_rng(1)
+    names = list(layers.names)
+    coeff = rng.uniform(0.5, 2, len(names)) * (rng.random(len(names)) < 0.7)
+    for _ in range(30):
+        i = rng.integers(len(names))
+        # switch a farm on or off, or change its coefficient
+        coeff[i] = 0 if coeff[i] and rng.random() < 0.5 else rng.uniform(0.5, 2)
+        got = compositor.render(names, coeff, session='a').copy()
+        expected = layers.composite(layers.coefficients(names, coeff))
+        expected[expected <= 0] = np.nan
+        np.testing.assert_array_equal(np.isnan(got), np.isnan(expected))
+        np.testing.assert_allclose(got, expected, rtol=1e-4, atol=1e-4, equal_nan=True)
@@ -0,0 +1,67 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import os
+import sys
+from collections import Counter
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import layers
+
+
+class CountingDataset:
+    '''
+    The farm variables of ds, counting how many times each one is read
+    '''
+    def __init__(self, ds):
+        self.ds, self.reads = ds, Counter()
+        self.sizes, self.coords = ds.sizes, ds.coords
+
+    def keys(self):
+        return self.ds.keys()
+
+    def __getitem__(self, name):
+        self.reads[name] += 1
+        return self.ds[name]
+
+
+def spread_farms(n_farms=6, shape=(20, 30)):
+    '''
+    Farms covering most of the grid, with NaNs, so the dense tensor is built
+    '''
+    rng = np.random.default_rng(0)
+    data = rng.uniform(0, 1, (n_farms,) + shape)
+    data[data < 0.1] = np.nan
+    return xr.Dataset({'farm_{}'.format(i): (('y', 'x'), data[i]) for i in range(n_farms)},
+                      coords={'y': np.arange(shape[0]), 'x': np.arange(shape[1])})
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'uint16'])
+@pytest.mark.parametrize('mmap', [False, True])
+def test_dense_fallback_reads_each_farm_once(tmp_path, dtype, mmap):
+    ds = spread_farms()
+    counting = CountingDataset(ds)
+    path = str(tmp_path / 'layers.npy') if mmap else None
+    built = layers.from_dataset(counting, path, dtype=dtype)
+    assert type(built) is layers.FarmLayers
+    assert counting.reads == Counter({name: 1 for name in ds.keys()})
+    expected = layers.FarmLayers.from_dataset(ds, dtype=dtype)
+    np.testing.assert_array_equal(built.data, expected.data)
+    assert list(built.names) == list(expected.names)
+    if mmap:
+        np.testing.assert_array_equal(layers.load(path).data, expected.data)
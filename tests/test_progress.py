@@ -0,0 +1,69 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from progress import load_all
+
+
+def reader(hung, release):
+    '''
+    Reads hanging until release is set for the paths in hung, at most
+    10s so that a regression fails rather than hangs
+    '''
+    timer = threading.Timer(10, release.set)
+    timer.daemon = True
+    timer.start()
+
+    def read(path):
+        if path in hung:
+            release.wait()
+        if path == 'bad':
+            raise IOError(path)
+        return path.upper()
+    return read
+
+
+def test_hung_stores_free_their_workers():
+    release = threading.Event()
+    try:
+        start = time.monotonic()
+        results, errors = load_all(['a', 'b', 'c', 'bad'], reader({'a', 'b'}, release),
+                                   max_workers=2, timeout=1)
+        assert time.monotonic() - start < 5
+    finally:
+        release.set()
+    assert results == [('c', 'C')]
+    assert set(errors) == {'a', 'b', 'bad'}
+    assert 'timed out' in errors['a']
+
+
+def test_deadline_gives_up_on_stores_not_started():
+    release = threading.Event()
+    paths = ['p{}'.format(i) for i in range(6)]
+    try:
+        start = time.monotonic()
+        results, errors = load_all(paths, reader(set(paths), release),
+                                   max_workers=2, timeout=60, deadline=1)
+        assert time.monotonic() - start < 5
+    finally:
+        release.set()
+    assert results == []
+    assert sorted(errors) == paths
+    assert 'not started' in errors['p5']
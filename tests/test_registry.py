@@ -0,0 +1,57 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import os
+import sys
+import threading
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from registry import LayerRegistry
+
+
+def farm_dataset(n_farms=3, shape=(6, 8)):
+    rng = np.random.default_rng(0)
+    return xr.Dataset({'farm_{}'.format(i): (('y', 'x'), rng.uniform(0, 1, shape))
+                       for i in range(n_farms)},
+                      coords={'y': np.arange(shape[0]), 'x': np.arange(shape[1])})
+
+
+def test_building_a_resolution_does_not_block_the_others(tmp_path):
+    building, release = threading.Event(), threading.Event()
+
+    def opener(r):
+        if r == 0:
+            building.set()
+            # at most 10s so that a regression fails rather than hangs
+            release.wait(10)
+        return farm_dataset()
+
+    registry = LayerRegistry(str(tmp_path), opener, lambda r: 'v1')
+    registry.get(1)
+    slow = threading.Thread(target=registry.get, args=(0,))
+    slow.start()
+    try:
+        assert building.wait(5)
+        done = threading.Thread(target=registry.get, args=(1,))
+        done.start()
+        done.join(2)
+        assert not done.is_alive()
+        assert registry.version(1) == 'v1'
+    finally:
+        release.set()
+        slow.join()
+    assert registry.get(0).shape == (6, 8)
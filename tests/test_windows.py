@@ -0,0 +1,72 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from windows import update_cumsum
+
+
+def daily_store(n_days, n_farms=3, shape=(4, 5), seed=0):
+    '''
+    Daily store of n_days in a dict, the same first days whatever n_days
+    '''
+    rng = np.random.default_rng(seed)
+    data = rng.uniform(0, 10, (n_farms, 20) + shape).astype('float32')
+    time = pd.date_range('2022-01-01', periods=n_days)
+    ds = xr.Dataset({'farm_{}'.format(i): (('time', 'y', 'x'), data[i, :n_days])
+                     for i in range(n_farms)},
+                    coords={'time': time, 'y': np.arange(shape[0]), 'x': np.arange(shape[1])})
+    store = {}
+    ds.chunk({'time': 1}).to_zarr(store)
+    return store, ds
+
+
+class FailingStore(dict):
+    '''
+    Raises on the writes of the chunks of one farm after some of them
+    '''
+    def __init__(self, farm, after):
+        super().__init__()
+        self.farm, self.after = farm, after
+
+    def __setitem__(self, key, value):
+        if self.farm and key.startswith(self.farm + '/') and not key.split('/')[-1].startswith('.'):
+            if self.after == 0:
+                raise OSError('write failed')
+            self.after -= 1
+        super().__setitem__(key, value)
+
+
+def test_update_cumsum_rerun_after_failure():
+    store = FailingStore(None, 0)
+    daily, _ = daily_store(6)
+    assert update_cumsum(daily, store) == 6
+    daily, ds = daily_store(12)
+    store.farm, store.after = 'farm_1', 2
+    with pytest.raises(OSError):
+        update_cumsum(daily, store)
+    store.farm = None
+    assert update_cumsum(daily, store) == 6
+    out = xr.open_zarr(store)
+    assert out.sizes['time'] == 12
+    np.testing.assert_array_equal(out.time.values, ds.time.values)
+    for name in ds.data_vars:
+        np.testing.assert_allclose(out[name].values, ds[name].cumsum('time').values, rtol=1e-5)
@@ -0,0 +1,160 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import numpy as np
+
+TILE_SIZE = 256
+EARTH_RADIUS = 6378137.0
+ORIGIN = np.pi * EARTH_RADIUS
+
+
+def lonlat_to_mercator(lon, lat):
+    '''
+    EPSG:4326 to EPSG:3857 metres
+    '''
+    x = np.radians(lon) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * EARTH_RADIUS
+    return x, y
+
+
+def mercator_to_lonlat(x, y):
+    '''
+    EPSG:3857 metres to EPSG:4326
+    '''
+    lon = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+def tile_pixel_size(z, lat, size=TILE_SIZE):
+    '''
+    Ground size (m) of the pixels of the tiles of zoom z at latitude lat
+    '''
+    return 2 * ORIGIN / (2**z * size) * np.cos(np.radians(lat))
+
+
+def tile_pixels(z, x, y, size=TILE_SIZE):
+    '''
+    Mercator coordinates of the pixel centres of an XYZ tile,
+    columns west to east and rows north to south
+    '''
+    res = 2 * ORIGIN / (2**z * size)
+    X = -ORIGIN + (x * size + np.arange(size) + 0.5) * res
+    Y = ORIGIN - (y * size + np.arange(size) + 0.5) * res
+    return X, Y
+
+
+class TileGrid:
+    '''
+    Place the farm layers on the web mercator tiles.
+    The grid is linear in mercator between the corners of the overlay,
+    as the mapbox image layer drew it, with the first row to the south.
+    corners are (lon, lat) in the mapbox order:
+    top left, top right, bottom right, bottom left.
+    '''
+    def __init__(self, corners, shape):
+        west, north = corners[0]
+        east, south = corners[2]
+        self.x0, self.y1 = lonlat_to_mercator(west, north)
+        self.x1, self.y0 = lonlat_to_mercator(east, south)
+        self.ny, self.nx = shape
+
+    def index(self, z, x, y, size=TILE_SIZE):
+        '''
+        Grid row and column of every tile pixel, out of range outside
+        '''
+        X, Y = tile_pixels(z, x, y, size)
+        cols = np.floor((X - self.x0) / (self.x1 - self.x0) * self.nx)
+        rows = np.floor((Y - self.y0) / (self.y1 - self.y0) * self.ny)
+        return rows.astype('intp'), cols.astype('intp')
+
+    def pixel(self, lon, lat):
+        '''
+        Grid row and column of a point, None outside the grid
+        '''
+        X, Y = lonlat_to_mercator(lon, lat)
+        col = int(np.floor((X - self.x0) / (self.x1 - self.x0) * self.nx))
+        row = int(np.floor((Y - self.y0) / (self.y1 - self.y0) * self.ny))
+        if 0 <= row < self.ny and 0 <= col < self.nx:
+            return row, col
+        return None
+
+
+def grid_corners(corners, base_y, base_x, y, x):
+    '''
+    Corners (mapbox order) of a grid of cell centres y, x laid over the
+    base grid of centres base_y, base_x whose corners are given, e.g. a
+    level of the pyramid padded to whole blocks of the base cells.
+    Only the first two centres of y and x are used.
+    '''
+    (west, north), _, (east, south), _ = corners
+    X0, Y1 = lonlat_to_mercator(west, north)
+    X1, Y0 = lonlat_to_mercator(east, south)
+
+    def edges(centres, base, m0, m1):
+        # outer edges of the first and last cells, the first cell at m0
+        step = base[1] - base[0]
+        first, last = base[0] - step / 2, base[-1] + step / 2
+        d = centres[1] - centres[0] if len(centres) > 1 else step * len(base)
+        lo, hi = centres[0] - d / 2, centres[0] + (len(centres) - 0.5) * d
+        scale = (m1 - m0) / (last - first)
+        return m0 + (lo - first) * scale, m0 + (hi - first) * scale
+
+    x0, x1 = edges(np.asarray(x, 'float64'), np.asarray(base_x, 'float64'), X0, X1)
+    y0, y1 = edges(np.asarray(y, 'float64'), np.asarray(base_y, 'float64'), Y0, Y1)
+    (w, s), (e, n) = mercator_to_lonlat(x0, y0), mercator_to_lonlat(x1, y1)
+    w, s, e, n = float(w), float(s), float(e), float(n)
+    return [[w, n], [e, n], [e, s], [w, s]]
+
+
+def render_tile(layers, w, grid, z, x, y, size=TILE_SIZE):
+    '''
+    Weighted sum of the layers on the pixels of one tile, only the
+    window of the grid under the tile is read.
+    NaN outside the grid and where the density is <= 0.
+    '''
+    out = np.full((size, size), np.nan, dtype='float32')
+    rows, cols = grid.index(z, x, y, size)
+    in_rows = (rows >= 0) & (rows < grid.ny)
+    in_cols = (cols >= 0) & (cols < grid.nx)
+    nz = np.flatnonzero(w)
+    if not in_rows.any() or not in_cols.any() or len(nz) == 0:
+        return out
+    rows, cols = rows[in_rows], cols[in_cols]
+    r0, c0 = rows.min(), cols.min()
+    window = layers.window(w, r0, rows.max() + 1, c0, cols.max() + 1)
+    out[np.ix_(in_rows, in_cols)] = window[np.ix_(rows - r0, cols - c0)]
+    out[out <= 0] = np.nan
+    return out
+
+
+
+def tile_index(lon, lat, z):
+    '''
+    XYZ tile containing a point
+    '''
+    n = 2**z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n)
+    return x, y
+
+
+def tiles_covering(corners, z):
+    '''
+    (x, y) of the tiles of zoom z under the overlay corners
+    (mapbox order, see TileGrid)
+    '''
+    x0, y0 = tile_index(*corners[0], z)
+    x1, y1 = tile_index(*corners[2], z)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
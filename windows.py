@@ -0,0 +1,141 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+'''
+Average over any time window. The cumulative store holds for each
+farm the running sum over time of its daily layers, so the mean of a
+window [first, last] is (C[last] - C[first-1]) / (last - first + 1):
+two slices per farm whatever the length of the window.
+It is written from the daily store, see frames.py, and only the days
+not processed yet are added on the next update.
+'''
+
+import sys
+import numpy as np
+
+from progress import load_all
+
+
+def update_cumsum(daily, store):
+    '''
+    Append to the cumulative store the days of the daily store that it
+    does not have yet. daily and store are zarr mappings.
+    Returns the number of days added.
+    '''
+    import zarr
+    from xarray import open_zarr
+    ds = open_zarr(daily)
+    root = zarr.open_group(store, mode='a')
+    n = ds.sizes['time']
+    processed = root.attrs.get('processed', 0)
+    if n <= processed:
+        return 0
+    ny, nx = ds.sizes['y'], ds.sizes['x']
+    for key in ('y', 'x'):
+        if key not in root:
+            root.array(key, ds[key].values, chunks=len(ds[key]))
+            root[key].attrs['_ARRAY_DIMENSIONS'] = [key]
+    if 'time' not in root:
+        root.zeros('time', shape=0, chunks=1024, dtype='M8[ns]')
+        root['time'].attrs['_ARRAY_DIMENSIONS'] = ['time']
+    # the days appended by an update that failed are written again
+    root['time'].resize(processed)
+    root['time'].append(ds.time.values[processed:].astype('M8[ns]'))
+    for name in ds.data_vars:
+        if name == 'spatial_ref':
+            continue
+        if name not in root:
+            chunks = (1,) + tuple(c[0] for c in ds[name].chunks[1:])
+            root.zeros(name, shape=(0, ny, nx), chunks=chunks, dtype='float32')
+            root[name].attrs['_ARRAY_DIMENSIONS'] = ['time', 'y', 'x']
+        total = root[name]
+        # a farm added later starts at 0 on the days processed before it
+        if total.shape[0] < processed:
+            total.append(np.zeros((processed - total.shape[0], ny, nx), dtype='float32'))
+        total.resize(processed, ny, nx)
+        running = total[processed - 1].astype('float64') if processed else np.zeros((ny, nx))
+        for day in range(processed, n):
+            running += np.nan_to_num(ds[name][day].values)
+            total.append(running[None].astype('float32'))
+    root.attrs['processed'] = n
+    zarr.consolidate_metadata(store)
+    return n - processed
+
+
+def window_composite(ds, names, coeff, first, last, max_workers=8):
+    '''
+    Weighted sum of the mean layers of the days first to last included,
+    NaN where the density is <= 0. ds is the cumulative store.
+    '''
+    shape = (ds.sizes['y'], ds.sizes['x'])
+    weights = {name: c for name, c in zip(names, coeff) if name in ds.data_vars}
+    out = np.zeros(shape, dtype='float32')
+
+    def read(name):
+        # the 0 fill value is decoded as NaN
+        total = np.nan_to_num(ds[name][last].values.astype('float64'))
+        if first > 0:
+            total -= np.nan_to_num(ds[name][first - 1].values)
+        return total
+
+    totals, errors = load_all(list(weights), read, max_workers=max_workers)
+    if errors:
+        raise IOError('cannot read {}'.format(', '.join(errors)))
+    for name, total in totals:
+        out += weights[name] * total
+    out /= last - first + 1
+    out[out <= 0] = np.nan
+    return out
+
+
+def window_column(ds, names, first, last, row, col, max_workers=8):
+    '''
+    Mean over the days first to last of each farm of names at one
+    pixel, 0 for the farms not in the cumulative store
+    '''
+    values = np.zeros(len(names), dtype='float32')
+    index = {name: i for i, name in enumerate(names) if name in ds.data_vars}
+
+    def read(name):
+        total = np.nan_to_num(float(ds[name][last, row, col]))
+        if first > 0:
+            total -= np.nan_to_num(float(ds[name][first - 1, row, col]))
+        return total
+
+    totals, errors = load_all(list(index), read, max_workers=max_workers)
+    if errors:
+        raise IOError('cannot read {}'.format(', '.join(errors)))
+    for name, total in totals:
+        values[index[name]] = total / (last - first + 1)
+    return values
+
+
+def window_index(times, start, end):
+    '''
+    Indices of the first and last days of times within [start, end]
+    '''
+    times = np.asarray(times).astype('M8[D]')
+    first = int(np.searchsorted(times, np.datetime64(start, 'D')))
+    last = int(np.searchsorted(times, np.datetime64(end, 'D'), side='right')) - 1
+    if last < first:
+        raise ValueError('no day between {} and {}'.format(start, end))
+    return first, last
+
+
+if __name__ == '__main__':
+    # python windows.py <daily.zarr> <cumsum.zarr>
+    import gcsfs
+    fs = gcsfs.GCSFileSystem()
+    n = update_cumsum(fs.get_mapper(sys.argv[1]), fs.get_mapper(sys.argv[2]))
+    print('{} new days'.format(n))